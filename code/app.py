@@ -3,7 +3,11 @@ import argparse
 from document import Report
 from reader import Reader
 from user_qa import UserQA
-#import cfg
+from corpus import CorpusRunner, collect_sources, write_outputs
+from global_index import GlobalIndex
+from llm_cache import get_llm_cache
+from llm_client import get_token_usage
+import cfg
 import webbrowser
 import asyncio
 from langchain.callbacks import get_openai_callback
@@ -15,6 +19,17 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--pdf_path", type=str, default=None)
     parser.add_argument("--pdf_url", type=str, default=None)
+    parser.add_argument("--pdf_dir", type=str, default=None, help="corpus mode: process every pdf in the directory")
+    parser.add_argument("--pdf_glob", type=str, default=None, help="corpus mode: process every pdf matching the pattern")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="corpus mode: text file with one pdf path or url per line")
+    parser.add_argument("--parse_workers", type=int, default=2,
+                        help="corpus mode: number of reports parsed and embedded concurrently")
+    parser.add_argument("--llm_workers", type=int, default=4,
+                        help="corpus mode: number of reports sent to the LLM concurrently")
+    parser.add_argument("--progress_path", type=str, default='data/corpus_progress.jsonl')
+    parser.add_argument("--global_index_dir", type=str, default='',
+                        help="corpus mode: append every processed report to the corpus-wide index in this directory")
     parser.add_argument("--basic_info_dir", type=str, default='data/basic_info')
     parser.add_argument("--llm_name", type=str, default='gpt-3.5-turbo')
     parser.add_argument("--answers_dir", type=str, default='data/answers')
@@ -26,15 +41,30 @@ def main():
     parser.add_argument("--answer_length", type=int, default=50)
     parser.add_argument("--detail", action='store_true', default=False)
     parser.add_argument("--top_k", type=int, default=20)
+    parser.add_argument("--extract_workers", type=int, default=1,
+                        help="number of processes used to extract PDF pages")
+    parser.add_argument("--llm_backend", type=str, default=cfg.llm_backend, choices=['openai', 'fake'],
+                        help="'fake' runs offline with canned answers and hashed embeddings (see fake_backend.py)")
+    parser.add_argument("--tracing_exporters", type=str, nargs='*', default=cfg.tracing_exporters,
+                        choices=['jsonl', 'prometheus'], help="where spans of stages and LLM requests go (tracing.py)")
+    parser.add_argument("--embedding_backend", type=str, default=cfg.embedding_backend, choices=['api', 'local'],
+                        help="'local' embeds with the sentence-transformers model of cfg.py on the CPU")
     args = parser.parse_args()
+    cfg.llm_backend = args.llm_backend
+    cfg.embedding_backend = args.embedding_backend
+    cfg.tracing_exporters = args.tracing_exporters
 
-    if args.pdf_path:
+    corpus_mode = args.pdf_dir or args.pdf_glob or args.manifest
+    if corpus_mode:
+        report_name = None
+    elif args.pdf_path:
         report_name = os.path.basename(args.pdf_path)
     else:
         assert (args.pdf_url is not None)
         report_name = args.pdf_url.split('/')[-1]
-    assert report_name.endswith('.pdf')
-    report_name = report_name.replace('.pdf', '')
+    if report_name is not None:
+        assert report_name.endswith('.pdf')
+        report_name = report_name.replace('.pdf', '')
 
     if not os.path.exists(args.basic_info_dir):
         os.makedirs(args.basic_info_dir)
@@ -52,51 +82,32 @@ def main():
     if not os.path.exists(destination_folder):
         os.makedirs(destination_folder)
 
+    if corpus_mode:
+        sources = collect_sources(pdf_dir=args.pdf_dir, pdf_glob=args.pdf_glob, manifest=args.manifest)
+        runner = CorpusRunner(args, parse_workers=args.parse_workers, llm_workers=args.llm_workers,
+                              progress_path=args.progress_path, pdf_store_dir=destination_folder,
+                              global_index=GlobalIndex(args.global_index_dir) if args.global_index_dir else None)
+        asyncio.run(runner.run(sources))
+        return
+
     report = Report(
         path=args.pdf_path,
         url=args.pdf_url,
         store_path=os.path.join(destination_folder, report_name + '.pdf'),
         db_path=os.path.join(args.vector_db_dir, report_name),
-        retrieved_chunks_path=os.path.join(args.retrieved_chunks_dir, report_name)
+        retrieved_chunks_path=os.path.join(args.retrieved_chunks_dir, report_name),
+        extract_workers=args.extract_workers,
+        # a user question only needs the stored vector database, the pdf is parsed only if there is none yet
+        lazy=args.user_question != '',
     )
 
     if args.user_question == '':
-        try:
-            reader = Reader(llm_name=args.llm_name, answer_length=str(args.answer_length),)
-                            # qa_prompt="tcfd_summary_source", answer_key_name='SUMMARY', q_name='Q', a_name='Summary')
-            result_qa = asyncio.run(reader.qa_with_chat(report_list=[report]))
-            result_analysis = asyncio.run(reader.analyze_with_chat(report_list=[report]))
-        except Exception as e:
-            if hasattr(e, 'message'):
-                msg = e.message
-            else:
-                msg = str(e)
-            if "This model's maximum context length is" in msg:
-                report = Report(
-                    path=os.path.join(destination_folder, args.pdf_path.split('/')[-1]),
-                    store_path=None,
-                    top_k=TOP_K - 5,
-                    db_path=os.path.join(args.vector_db_dir, report_name),
-                    retrieved_chunks_path=os.path.join(args.retrieved_chunks_dir, report_name),
-                )
-                reader = Reader(llm_name=args.llm_name, answer_length=str(args.answer_length),)
-                                #qa_prompt="tcfd_summary_source", answer_key_name='SUMMARY', q_name='Q', a_name='Summary')
-                result_qa = asyncio.run(reader.qa_with_chat(report_list=[report]))
-                result_analysis = asyncio.run(reader.analyze_with_chat(report_list=[report]))
-
-        html_path_qa = report_name + '_' + args.llm_name + '_qa.html'
-        html_path_analysis = report_name + '_' + args.llm_name + '_analysis.html'
-        with open(html_path_qa, 'w') as f:
-            f.write(result_qa[0])
-        with open(html_path_analysis, 'w') as f:
-            f.write(result_analysis[0])
+        # prompts exceeding the context window are retried with fewer chunks by the LLM client
+        reader = Reader(llm_name=args.llm_name, answer_length=str(args.answer_length),)
+                        # qa_prompt="tcfd_summary_source", answer_key_name='SUMMARY', q_name='Q', a_name='Summary')
+        result_qa, result_analysis = asyncio.run(reader.qa_and_analyze_with_chat(report_list=[report]))
         # webbrowser.open(html_path)
-        with open(os.path.join(args.basic_info_dir, report_name + '_' + args.llm_name + '.json'), 'w') as f:
-            json.dump(reader.basic_info_answers[0], f)
-        with open(os.path.join(args.answers_dir, report_name + '_' + args.llm_name + '.json'), 'w') as f:
-            json.dump(reader.answers[0], f)
-        with open(os.path.join(args.assessment_dir, report_name + '_' + args.llm_name + '.json'), 'w') as f:
-            json.dump(reader.assessment_results[0], f)
+        write_outputs(args, report_name, reader, result_qa, result_analysis)
     else:
         qa = UserQA(llm_name=args.llm_name)
         answer, _ = qa.user_qa(
@@ -115,3 +126,7 @@ if __name__ == '__main__':
     with get_openai_callback() as cb:
         main()
         print(cb)
+        if get_llm_cache() is not None:
+            print('LLM cache:', get_llm_cache().stats())
+        # input tokens the server served from its prompt-prefix cache (static instructions come first in every prompt)
+        print('token usage:', get_token_usage().stats())
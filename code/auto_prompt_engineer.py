@@ -1,6 +1,6 @@
 import json
+import asyncio
 
-from langchain.chat_models import ChatOpenAI
 from langchain.prompts import PromptTemplate
 from langchain.schema import (
     AIMessage,
@@ -10,7 +10,9 @@ from langchain.schema import (
 
 import argparse
 from document import Report
-from reader import Reader
+from user_qa import UserQA
+from llm_client import LLMClient
+from tracing import get_tracer, set_trace_context
 import os
 
 ORIGINAL_PROMPT = """As a senior equity analyst with expertise in climate science evaluating a company's sustainability report, you are presented with the following background information:
@@ -91,6 +93,7 @@ if __name__ == '__main__':
     parser.add_argument("--answers_dir", type=str, default='data/answers')
     parser.add_argument("--assessment_dir", type=str, default='data/assessment')
     parser.add_argument("--vector_db_dir", type=str, default='data/vector_db')
+    parser.add_argument("--retrieved_chunks_dir", type=str, default='data/retrieved_chunks')
     parser.add_argument("--user_qa_dir", type=str, default='data/user_qa')
     parser.add_argument("--prompt_eng_dir", type=str, default='data/auto_prompt_eng')
     parser.add_argument("--user_question", type=str, default='')
@@ -122,21 +125,30 @@ if __name__ == '__main__':
     if not os.path.exists(destination_folder):
         os.makedirs(destination_folder)
 
+    # only the vector database is needed, the pdf is parsed only if it has not been processed before
     report = Report(
         path=args.pdf_path,
         store_path=os.path.join(destination_folder, args.pdf_path.split('/')[-1]),
         db_path=os.path.join(args.vector_db_dir, report_name),
+        retrieved_chunks_path=os.path.join(args.retrieved_chunks_dir, report_name),
+        lazy=True,
     )
 
-    reader = Reader(llm_name="gpt-3.5-turbo-16k", answer_length=str(args.answer_length))
+    qa = UserQA(llm_name="gpt-3.5-turbo-16k")
     engineering_template = PromptTemplate(template=REFINE_PROMPT, input_variables=["original_prompt", "guideline_list", "old_response", "feedback"])
+    refine_client = LLMClient("gpt-3.5-turbo")
     print("=====Starting Automatic Prompt Engineering=====")
+    # spans of the loop are tagged with the report and the iteration they belong to
+    set_trace_context(report=report_name, task='prompt_engineering')
+    iteration = 0
     while True:
-        output, _ = reader.user_qa(args.user_question, report,
-                                   basic_info_path=os.path.join(args.basic_info_dir, report_name + '.json'),
-                                   answer_length=args.answer_length,
-                                   prompt_template=PROMPT_BEGINNING + '\n' + GUIDELINE_LIST + '\n' + PROMPT_ENDING,
-                                   various_source=args.detail, top_k=args.top_k)
+        iteration += 1
+        set_trace_context(iteration=iteration)
+        output, _ = qa.user_qa(args.user_question, report,
+                               basic_info_path=os.path.join(args.basic_info_dir, report_name + '.json'),
+                               answer_length=args.answer_length,
+                               prompt_template=PROMPT_BEGINNING + '\n' + GUIDELINE_LIST + '\n' + PROMPT_ENDING,
+                               top_k=args.top_k)
         answer = {"ANSWER": output['ANSWER'], "SOURCES": output['SOURCES']}
         print("\nGiven your question and the current prompt, the answer is:")
         print(answer)
@@ -148,8 +160,9 @@ if __name__ == '__main__':
             SystemMessage(content="You are a helpful prompt engineer."),
             HumanMessage(content=current_prompt)
         ]
-        llm = ChatOpenAI(temperature=0, max_tokens=256)
-        output_text = llm(message).content
+        # the expert's time to answer is not part of any span
+        with get_tracer().span('prompt_refinement', model=refine_client.llm_name):
+            output_text = asyncio.run(refine_client.generate_one(message, max_tokens=256, key='guideline'))
         try:
             output_dict = json.loads(output_text)
             if 'GUIDELINE' not in output_dict.keys():
@@ -0,0 +1,195 @@
+"""
+ end-to-end benchmark of the report pipeline: every report of a set of PDFs (by default the sample reports of
+ annotated_data/sustainability_reports.zip) is run from scratch, stage by stage, and wall time, CPU time, memory and
+ API requests / tokens are recorded per stage (open, extract, title, chunking, embedding, retrieval, prompt_build,
+ llm, parsing, render). The results are written as JSON, so that runs of different commits can be compared.
+ Runs against the offline fake backend by default (see fake_backend.py), so timings do not depend on the network
+"""
+import os
+import json
+import time
+import shutil
+import asyncio
+import zipfile
+import argparse
+import contextlib
+import subprocess
+
+import cfg
+from llm_client import get_api_pool, get_token_usage
+from memory_usage import rss_bytes, peak_rss_bytes
+
+STAGES = ('open', 'extract', 'title', 'chunking', 'embedding', 'retrieval', 'prompt_build', 'llm', 'parsing',
+          'render')
+# counters summed over all entries of a stage
+COUNTERS = ('wall_seconds', 'cpu_seconds', 'rss_delta_mb', 'api_requests', 'api_tokens', 'llm_requests',
+            'input_tokens', 'cached_input_tokens', 'output_tokens')
+DEFAULT_ZIP = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'annotated_data',
+                                            'sustainability_reports.zip'))
+LFS_POINTER = b'version https://git-lfs'
+
+
+class StageRecorder:
+    """ measurements of named stages, a stage entered several times (e.g. one LLM batch per report) adds up """
+
+    def __init__(self, api_pool=None):
+        self.api_pool = api_pool if api_pool is not None else get_api_pool()
+        self.stages = {}
+
+    def _snapshot(self):
+        usage = get_token_usage().stats()
+        return {'wall_seconds': time.perf_counter(), 'cpu_seconds': time.process_time(),
+                'rss_delta_mb': rss_bytes() / 2 ** 20,
+                # every request sent through the key pool (chat, completion and embedding), tokens as booked
+                'api_requests': sum(b.num_requests for b in self.api_pool.budgets),
+                'api_tokens': sum(b.num_tokens for b in self.api_pool.budgets),
+                # chat and completion requests, tokens as reported by the server
+                'llm_requests': usage['requests'], 'input_tokens': usage['input_tokens'],
+                'cached_input_tokens': usage['cached_input_tokens'], 'output_tokens': usage['output_tokens']}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ stages must not overlap (the recorder measures the whole process), coroutines are run one after another """
+        start = self._snapshot()
+        try:
+            yield
+        finally:
+            end = self._snapshot()
+            record = self.stages.setdefault(name, dict({c: 0 for c in COUNTERS}, calls=0, peak_rss_mb=0.))
+            for counter in COUNTERS:
+                record[counter] += end[counter] - start[counter]
+            record['calls'] += 1
+            record['peak_rss_mb'] = max(record['peak_rss_mb'], peak_rss_bytes() / 2 ** 20)
+
+    def results(self):
+        """ :return: measurements per stage, in pipeline order """
+        names = [s for s in STAGES if s in self.stages] + [s for s in self.stages if s not in STAGES]
+        return {name: {k: round(v, 3) if isinstance(v, float) else v for k, v in self.stages[name].items()}
+                for name in names}
+
+
+def extract_pdfs(zip_path, pdf_dir):
+    """ :return: paths of the pdfs of the archive, extracted to pdf_dir unless they are there already """
+    if not zipfile.is_zipfile(zip_path):
+        with open(zip_path, 'rb') as f:
+            is_pointer = f.read(len(LFS_POINTER)) == LFS_POINTER
+        raise ValueError("{} is {}".format(zip_path, "a git-lfs pointer, fetch it with `git lfs pull`" if is_pointer
+                                           else "not a zip archive"))
+    paths = []
+    with zipfile.ZipFile(zip_path) as archive:
+        for member in sorted(archive.namelist()):
+            name = os.path.basename(member)
+            if not name.lower().endswith('.pdf') or name.startswith('.'):  # skips __MACOSX/._ resource forks
+                continue
+            path = os.path.join(pdf_dir, name)
+            if not os.path.exists(path):
+                os.makedirs(pdf_dir, exist_ok=True)
+                with archive.open(member) as src, open(path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+            paths.append(path)
+    return paths
+
+
+def benchmark_report(pdf_path, run_dir, llm_name='gpt-3.5-turbo', extract_workers=1):
+    """ run the pipeline on one pdf without any stored artifacts, :return: its measurements """
+    from document import Report
+    from reader import Reader
+
+    report_name = os.path.basename(pdf_path)[:-len('.pdf')]
+    recorder = StageRecorder()
+    start_time = time.perf_counter()
+    report = Report(path=pdf_path, db_path=os.path.join(run_dir, 'vector_db', report_name),
+                    retrieved_chunks_path=os.path.join(run_dir, 'retrieved_chunks', report_name),
+                    extract_workers=extract_workers, lazy=True)
+    # the lazy attributes are computed one stage at a time, in the order parse_pdf computes them
+    with recorder.stage('open'):
+        report.pdf
+    with recorder.stage('extract'):
+        report.extract_pages()
+    with recorder.stage('title'):
+        report.title
+    with recorder.stage('chunking'):
+        report.chunks
+    with recorder.stage('embedding'):
+        report.vector_db
+    with recorder.stage('retrieval'):
+        report.section_text_dict
+    report.pdf.close()
+    reader = Reader(llm_name=llm_name, stage=recorder.stage)
+    # QA and analysis one after the other, so that their stages do not overlap
+    asyncio.run(reader.qa_with_chat(report_list=[report]))
+    asyncio.run(reader.analyze_with_chat(report_list=[report]))
+    return {'report': report_name, 'pages': len(report.pages), 'chunks': len(report.chunks),
+            'wall_seconds': round(time.perf_counter() - start_time, 3), 'stages': recorder.results()}
+
+
+def summarize(reports):
+    """ :return: measurements per stage summed over all reports (peak RSS is the maximum) """
+    totals = {}
+    for report in reports:
+        for name, record in report['stages'].items():
+            total = totals.setdefault(name, dict({c: 0 for c in COUNTERS}, calls=0, peak_rss_mb=0.))
+            for counter in COUNTERS + ('calls',):
+                total[counter] += record[counter]
+            total['peak_rss_mb'] = max(total['peak_rss_mb'], record['peak_rss_mb'])
+    return {name: {k: round(v, 3) if isinstance(v, float) else v for k, v in total.items()}
+            for name, total in totals.items()}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--zip", type=str, default=DEFAULT_ZIP, help="archive of the sample reports")
+    parser.add_argument("--pdfs", type=str, nargs='*', default=None, help="pdfs to run instead of the archive")
+    parser.add_argument("--limit", type=int, default=0, help="only the first n reports")
+    parser.add_argument("--work_dir", type=str, default='data/benchmark',
+                        help="extracted pdfs and the artifacts of the run, removed before every run")
+    parser.add_argument("--llm_name", type=str, default='gpt-3.5-turbo')
+    parser.add_argument("--llm_backend", type=str, default='fake', choices=['openai', 'fake'])
+    parser.add_argument("--extract_workers", type=int, default=1)
+    parser.add_argument("--caches", action='store_true', default=False,
+                        help="keep the LLM and embedding caches on (off by default, so every run starts cold)")
+    parser.add_argument("--output", type=str, default='', help="JSON file the results are written to")
+    args = parser.parse_args()
+
+    cfg.llm_backend = args.llm_backend
+    if not args.caches:
+        cfg.use_llm_cache = False
+        cfg.use_embedding_cache = False
+    pdf_paths = args.pdfs or extract_pdfs(args.zip, os.path.join(args.work_dir, 'pdfs'))
+    if args.limit:
+        pdf_paths = pdf_paths[:args.limit]
+    run_dir = os.path.join(args.work_dir, 'run')
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+
+    reports = []
+    start_time = time.perf_counter()
+    for pdf_path in pdf_paths:
+        reports.append(benchmark_report(pdf_path, run_dir, llm_name=args.llm_name,
+                                        extract_workers=args.extract_workers))
+    results = {
+        'commit': _git_commit(),
+        'config': {'llm_backend': cfg.llm_backend, 'llm_name': args.llm_name, 'caches': args.caches,
+                   'extract_workers': args.extract_workers, 'faiss_index_type': cfg.faiss_index_type,
+                   'vector_storage': cfg.vector_storage, 'compression': cfg.compression},
+        'wall_seconds': round(time.perf_counter() - start_time, 3),
+        'peak_rss_mb': round(peak_rss_bytes() / 2 ** 20, 1),
+        'stages': summarize(reports),
+        'reports': reports,
+    }
+    print(json.dumps(results['stages'], indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
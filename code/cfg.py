@@ -6,12 +6,103 @@ temperature = 0.
 chunk_size = 500
 # overlap length between chunks
 chunk_overlap = 20
-# whether to use document compression
-compression = False
-# similarity threshold to remove the less-related chunks (from the retrieved top-k)
+# whether to post-process retrieved chunks: similarity threshold and removal of (near-)duplicate chunks
+compression = True
+# similarity threshold to remove the less-related chunks (from the retrieved top-k), tuned for
+# text-embedding-ada-002, whose cosine similarities are all high. The local model spreads them far wider and has
+# its own threshold (embedding_backend = 'local'), retune it when changing local_embedding_model
 similarity_threshold = 0.76
+local_similarity_threshold = 0.35
+# chunks kept per query even if they are below the threshold
+similarity_min_chunks = 3
+# share of the word 3-grams of a chunk found in a better ranked chunk that makes it a near-duplicate
+near_duplicate_threshold = 0.8
 # how many related chunks to be retrieved?
 retriever_top_k = 20
+# rate limits of every api key in apikey.ini (requests / tokens per minute), requests are spread over all keys;
+# the api limits every model on its own, chat / completion and embedding requests have separate budgets
+api_rpm_limit = 3500
+api_tpm_limit = 90000
+api_embedding_rpm_limit = 3000
+api_embedding_tpm_limit = 1000000
+# backend of all LLM and embedding requests: 'openai', or 'fake' to run the whole pipeline offline with canned
+# answers and hashed embeddings (see fake_backend.py), e.g. for benchmarking without keys or network
+llm_backend = 'openai'
+# fake backend: seconds per chat request, plus seconds per 1000 prompt tokens
+fake_llm_latency = 0.5
+fake_llm_latency_per_1k_tokens = 0.05
+# fake backend: seconds per embedding request and dimension of the embeddings
+fake_embedding_latency = 0.1
+fake_embedding_dim = 256
+# fake backend: number of keys, chat requests per minute and key before the server answers 429 (0: no limit),
+# share of chat requests failing with a transient error, and seed of these failures
+fake_num_keys = 4
+fake_rpm_limit = 0
+fake_error_rate = 0.
+fake_seed = 0
+# exporters of the spans of pipeline stages and LLM requests (see tracing.py): 'jsonl' appends one JSON object per
+# span to tracing_jsonl_path, 'prometheus' keeps counters per stage and model and serves them on
+# tracing_prometheus_host:tracing_prometheus_port (port 0: only on /metrics of qa_server.py); the host is local
+# only by default, '0.0.0.0' exposes the metrics on all interfaces
+tracing_exporters = []
+tracing_jsonl_path = 'data/traces.jsonl'
+tracing_prometheus_host = '127.0.0.1'
+tracing_prometheus_port = 0
+# attempts per LLM request before giving up (rate limits, timeouts and server errors are retried)
+llm_max_retries = 6
+# responses are cached on disk, keyed on model, prompt and max_tokens (temperature is always 0)
+use_llm_cache = True
+llm_cache_path = 'data/llm_cache.sqlite'
+llm_cache_max_bytes = 512 * 1024 * 1024
+# embedding model of the vector databases: 'api' (text-embedding-ada-002 through the api key pool, or the fake
+# backend) or 'local' (a sentence-transformers model on the CPU, no embedding requests; see local_embeddings.py).
+# The model is recorded with every vector database, a database is never searched with another model
+embedding_backend = 'api'
+local_embedding_model = 'sentence-transformers/all-MiniLM-L6-v2'
+# local model: texts per forward pass and torch threads (0: one per core)
+local_embedding_batch_size = 64
+local_embedding_threads = 0
+# api embedding requests carry at most embedding_batch_tokens tokens (and 1000 texts), at most
+# embedding_concurrency of them are in flight at a time; during ingest the chunks of the first pages are embedded
+# while later pages are still being extracted
+embedding_batch_tokens = 20000
+embedding_concurrency = 4
+# chunk embeddings are stored by text hash and reused by every report containing the same chunk
+use_embedding_cache = True
+embedding_cache_dir = 'data/embedding_cache'
+# context window (tokens) per model, retrieved chunks are packed into what is left after prompt and answer
+context_windows = {
+    'gpt-3.5-turbo': 4096,
+    'gpt-3.5-turbo-16k': 16384,
+    'gpt-4': 8192,
+    'gpt-4-32k': 32768,
+    'text-davinci-003': 4097,
+}
+default_context_window = 4096
+# tokens kept free as a safety margin, the server counts a few tokens more than tiktoken does
+prompt_token_margin = 100
+# FAISS index built for every report: 'flat' (exact search), or the approximate 'ivf', 'hnsw', 'pq' and 'ivfpq'
+# (faster and / or smaller for large indexes, see vector_index.py for a recall / latency comparison)
+faiss_index_type = 'flat'
+# ivf: number of clusters (reduced for small indexes) and clusters visited per query
+faiss_nlist = 1024
+faiss_nprobe = 16
+# hnsw: neighbours per node and size of the candidate list per query
+faiss_hnsw_m = 32
+faiss_ef_search = 64
+# pq: bytes per vector, reduced to a divisor of the embedding dimension if necessary; indexes of fewer than
+# 256 * 39 vectors cannot train 8-bit codes and are flat
+faiss_pq_m = 64
+# storage of the vector databases: 'faiss' (index and pickled docstore read into memory) or 'mmap' (vectors and
+# chunk texts memory-mapped, only what searches touch is resident; exact search, see mapped_store.py)
+vector_storage = 'faiss'
+# dtype of memory-mapped vectors: 'float16' halves the file of 'float32'
+mapped_vector_dtype = 'float16'
+# corpus-wide index holding the chunk vectors of every processed report (see global_index.py), of type
+# faiss_index_type
+global_index_dir = 'data/global_index'
+# chunks per report in the context of a corpus-wide question, so that one report cannot take all sources
+global_qa_max_per_report = 3
 
 retrieval_queries = {
     'general': ["What is the company of the report?", "What sector does the company belong to?", "Where is the company located?",
@@ -160,18 +251,14 @@ QUESTIONS:
 =========
 Your FINAL_ANSWER in JSON (ensure there's no format error):
 """,
-    'tcfd_qa_source': """As a senior equity analyst with expertise in climate science evaluating a company's sustainability report, you are presented with the following background information:
-
-{basic_info}
-
-With the above information and the following extracted components of the sustainability report at hand, please respond to the posed question, ensuring to reference the relevant parts ("SOURCES").
-Format your answer in JSON format with the two keys: ANSWER (this should contain your answer string without sources), and SOURCES (this should be a list of the source numbers that were referenced in your answer).
-
-QUESTION: {question}
+    'tcfd_qa_source': """The following extracted components of a company's sustainability report, each with its source number, are the report context of this task:
 =========
 {summaries}
 =========
 
+As a senior equity analyst with expertise in climate science evaluating the company's sustainability report, you are asked to respond to a question about the report based on the above extracts, ensuring to reference the relevant parts ("SOURCES").
+Format your answer in JSON format with the two keys: ANSWER (this should contain your answer string without sources), and SOURCES (this should be a list of the source numbers that were referenced in your answer).
+
 Please adhere to the following guidelines in your answer:
 1. Your response must be precise, thorough, and grounded on specific extracts from the report to verify its authenticity.
 2. If you are unsure, simply acknowledge the lack of knowledge, rather than fabricating an answer.
@@ -180,8 +267,15 @@ Please adhere to the following guidelines in your answer:
 5. cheap talks are statements that are costless to make and may not necessarily reflect the true intentions or future actions of the company. Be critical for all cheap talks you discovered in the report.
 6. Always acknowledge that the information provided is representing the company's view based on its report.
 7. Scrutinize whether the report is grounded in quantifiable, concrete data or vague, unverifiable statements, and communicate your findings.
-{guidelines}
 
+You are presented with the following background information:
+
+{basic_info}
+
+With the above information and the extracted components of the sustainability report at hand, please respond to the posed question.
+
+QUESTION: {question}
+{guidelines}
 Your FINAL_ANSWER in JSON (ensure there's no format error):
 """,
     'user_qa_source': """As a senior equity analyst with expertise in climate science evaluating a company's sustainability report, you are presented with the following background information:
@@ -206,6 +300,26 @@ Please adhere to the following guidelines in your answer:
 7. Always acknowledge that the information provided is representing the company's view based on its report.
 8. Scrutinize whether the report is grounded in quantifiable, concrete data or vague, unverifiable statements, and communicate your findings.
 
+Your FINAL_ANSWER in JSON (ensure there's no format error):
+""",
+    'corpus_qa_source': """As a senior equity analyst with expertise in climate science comparing the sustainability reports of several companies, you are presented with the following extracted components of the reports. Every component names the company and year of its report.
+
+Respond to the posed question across all reports, naming the companies your statements refer to and ensuring to reference the relevant parts ("SOURCES").
+Format your answer in JSON format with the two keys: ANSWER (this should contain your answer string without sources), and SOURCES (this should be a list of the source numbers that were referenced in your answer).
+
+QUESTION: {question}
+=========
+{summaries}
+=========
+
+Please adhere to the following guidelines in your answer:
+1. Your response must be precise, thorough, and grounded on specific extracts from the reports to verify its authenticity.
+2. If certain information is unclear or unavailable, admit the lack of knowledge rather than devising an answer.
+3. Answer the question strictly based on the provided extracts. A company whose extracts do not address the question must not be said to disclose it.
+4. Keep your ANSWER within {answer_length} words.
+5. Be skeptical to the information disclosed in the reports as there might be greenwashing (exaggerating the firm's environmental responsibility). Always answer in a critical tone.
+6. Always acknowledge that the information provided is representing the companies' view based on their reports.
+
 Your FINAL_ANSWER in JSON (ensure there's no format error):
 """,
     'tcfd_summary_source': """Your task is to analyze and summarize any disclosures related to the following <CRITICAL_ELEMENT> in a company's sustainability report:
@@ -249,29 +363,25 @@ QUESTION: {question}
 {summaries}
 =========
 """,
-    'tcfd_assessment': """Your task is to rate a sustainability report's disclosure quality on the following <CRITICAL_ELEMENT>:
+    'tcfd_assessment': """The following extracted components of a company's sustainability report, each with its source number, are the report context of this task:
+=========
+{disclosure}
+=========
 
-<CRITICAL_ELEMENT>: {question}
+Your task is to rate the sustainability report's disclosure quality on a <CRITICAL_ELEMENT>, given the <REQUIREMENTS> that outline the necessary components for high-quality disclosure pertaining to the <CRITICAL_ELEMENT>.
+The above extracts, which pertain to the <CRITICAL_ELEMENT>, are the <DISCLOSURE> (their source numbers can be ignored).
+Please analyze the extent to which the given <DISCLOSURE> satisfies the <REQUIREMENTS>. Your ANALYSIS should specify which <REQUIREMENTS> have been met and which ones have not been satisfied.
+Your response should be formatted in JSON with two keys:
+1. ANALYSIS: A paragraph of analysis (be in a string format). No longer than 150 words.
+2. SCORE: An integer score from 0 to 100. A score of 0 indicates that most of the <REQUIREMENTS> have not been met or are insufficiently detailed. In contrast, a score of 100 suggests that the majority of the <REQUIREMENTS> have been met and are accompanied by specific details.
 
-These are the <REQUIREMENTS> that outline the necessary components for high-quality disclosure pertaining to the <CRITICAL_ELEMENT>:
+<CRITICAL_ELEMENT>: {question}
 
 <REQUIREMENTS>:
 ---
 {requirements}
 ---
 
-Presented below are select excerpts from the sustainability report, which pertain to the <CRITICAL_ELEMENT>:
-
-<DISCLOSURE>:
----
-{disclosure}
----
-
-Please analyze the extent to which the given <DISCLOSURE> satisfies the aforementioned <REQUIREMENTS>. Your ANALYSIS should specify which <REQUIREMENTS> have been met and which ones have not been satisfied.
-Your response should be formatted in JSON with two keys:
-1. ANALYSIS: A paragraph of analysis (be in a string format). No longer than 150 words.
-2. SCORE: An integer score from 0 to 100. A score of 0 indicates that most of the <REQUIREMENTS> have not been met or are insufficiently detailed. In contrast, a score of 100 suggests that the majority of the <REQUIREMENTS> have been met and are accompanied by specific details.
-
 Your FINAL_ANSWER in JSON (ensure there's no format error):
 """,
     'scoring': """Your task is to rate the disclosure quality of a sustainability report. You'll be provided with a <REPORT SUMMARY> that contains {question_number} (DISCLOSURE_REQUIREMENT, DISCLOSURE_CONTENT) pairs. DICLOSURE_REQUIREMENT corresponds to a key piece of information that the report should disclose. DISCLOSURE_CONTENT summarizes the report's disclosed information on that topic. 
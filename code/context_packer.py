@@ -0,0 +1,55 @@
+"""
+ decides how many retrieved chunks fit into a prompt, given the context window of the model
+"""
+import functools
+
+import cfg
+from llm_client import get_encoder
+
+# tokens added by the chat format for every message
+MESSAGE_OVERHEAD = 4
+# token counts of this many recent texts are kept, about the chunks and prompts of a few reports
+TOKEN_COUNT_CACHE_SIZE = 4096
+
+
+def context_window(llm_name):
+    if llm_name in cfg.context_windows:
+        return cfg.context_windows[llm_name]
+    # dated snapshots such as gpt-3.5-turbo-0613 share the window of their base model
+    matches = [name for name in cfg.context_windows if llm_name.startswith(name)]
+    if matches:
+        return cfg.context_windows[max(matches, key=len)]
+    return cfg.default_context_window
+
+
+class ContextPacker:
+    def __init__(self, llm_name, encoder=None, margin=cfg.prompt_token_margin):
+        self.llm_name = llm_name
+        self.encoder = encoder if encoder is not None else get_encoder(llm_name)
+        self.context_window = context_window(llm_name)
+        self.margin = margin
+        # chunks recur across questions and passes; bounded, a packer may live as long as a server process
+        self.count_tokens = functools.lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)(self._count_tokens)
+
+    def _count_tokens(self, text):
+        return len(self.encoder.encode(text))
+
+    def fit(self, fixed_prompt, blocks, max_tokens=512, system_prompt=None):
+        """
+        :param fixed_prompt: the prompt rendered without any chunk
+        :param blocks: rendered chunks in ranking order
+        :param max_tokens: tokens reserved for the answer
+        :param system_prompt: system message sent along with the prompt (chat models)
+        :return: number of leading blocks that fit into the context window (at least one)
+        """
+        budget = self.context_window - max_tokens - self.margin - self.count_tokens(fixed_prompt)
+        if system_prompt is not None:
+            budget -= self.count_tokens(system_prompt) + 2 * MESSAGE_OVERHEAD
+        num_blocks = 0
+        for block in blocks:
+            tokens = self.count_tokens(block)
+            if tokens > budget:
+                break
+            budget -= tokens
+            num_blocks += 1
+        return max(num_blocks, min(1, len(blocks)))
@@ -0,0 +1,210 @@
+"""
+ corpus mode: run the ChatReport pipeline over many reports, with bounded concurrency for each stage
+"""
+import os
+import json
+import glob
+import time
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from document import Report, download_pdf
+from reader import Reader
+from llm_client import LLMClient
+
+
+def is_url(source):
+    return source.startswith('http://') or source.startswith('https://')
+
+
+def get_report_name(source):
+    report_name = source.split('/')[-1] if is_url(source) else os.path.basename(source)
+    if not report_name.endswith('.pdf'):
+        raise ValueError('{} does not name a .pdf file'.format(source))
+    return report_name.replace('.pdf', '')
+
+
+def collect_sources(pdf_dir=None, pdf_glob=None, manifest=None):
+    """
+    gather the reports of a corpus
+    :param pdf_dir: directory whose *.pdf files are processed
+    :param pdf_glob: glob pattern matching pdf files (** is allowed)
+    :param manifest: text file with one pdf path or url per line, lines starting with # are skipped
+    :return: list of pdf paths and urls without duplicates, in input order
+    """
+    sources = []
+    if pdf_dir:
+        sources += sorted(glob.glob(os.path.join(pdf_dir, '*.pdf')))
+    if pdf_glob:
+        sources += sorted(glob.glob(pdf_glob, recursive=True))
+    if manifest:
+        with open(manifest, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    sources.append(line)
+    unique_sources = []
+    for source in sources:
+        if source not in unique_sources:
+            unique_sources.append(source)
+    return unique_sources
+
+
+def output_paths(args, report_name):
+    suffix = report_name + '_' + args.llm_name
+    return {
+        'qa_html': suffix + '_qa.html',
+        'analysis_html': suffix + '_analysis.html',
+        'basic_info': os.path.join(args.basic_info_dir, suffix + '.json'),
+        'answers': os.path.join(args.answers_dir, suffix + '.json'),
+        'assessment': os.path.join(args.assessment_dir, suffix + '.json'),
+    }
+
+
+def write_outputs(args, report_name, reader, result_qa, result_analysis):
+    paths = output_paths(args, report_name)
+    with open(paths['qa_html'], 'w') as f:
+        f.write(result_qa[0])
+    with open(paths['analysis_html'], 'w') as f:
+        f.write(result_analysis[0])
+    with open(paths['basic_info'], 'w') as f:
+        json.dump(reader.basic_info_answers[0], f)
+    with open(paths['answers'], 'w') as f:
+        json.dump(reader.answers[0], f)
+    with open(paths['assessment'], 'w') as f:
+        json.dump(reader.assessment_results[0], f)
+
+
+def build_report(args, source, pdf_store_dir='data/pdf/', lazy=False):
+    """
+    parse, embed and retrieve a report given by path or url, with the artifact directories of args
+    :param lazy: only do what is needed once the report is used, stored vector database and retrievals are reused
+    """
+    report_name = get_report_name(source)
+    return Report(
+        path=None if is_url(source) else source,
+        url=source if is_url(source) else None,
+        store_path=os.path.join(pdf_store_dir, report_name + '.pdf'),
+        db_path=os.path.join(args.vector_db_dir, report_name),
+        retrieved_chunks_path=os.path.join(args.retrieved_chunks_dir, report_name),
+        extract_workers=args.extract_workers,
+        lazy=lazy,
+    )
+
+
+class CorpusRunner:
+    def __init__(self, args, parse_workers=2, llm_workers=4, progress_path='data/corpus_progress.jsonl',
+                 pdf_store_dir='data/pdf/', global_index=None):
+        self.args = args
+        # processed reports are appended to this corpus-wide index (GlobalIndex), if given
+        self.global_index = global_index
+        self.parse_workers = parse_workers  # reports parsed and embedded at the same time
+        self.llm_workers = llm_workers  # reports whose prompts are in flight at the same time
+        self.progress_path = progress_path
+        self.pdf_store_dir = pdf_store_dir
+        self.parse_pool = ThreadPoolExecutor(max_workers=parse_workers)
+        # downloaded pdfs by content: sha256 -> report that was (or is being) parsed and embedded for it
+        self.content_index_path = os.path.join(pdf_store_dir, 'content_index.jsonl')
+        self.content_lock = threading.Lock()
+        self.reports_by_hash = {}
+        if os.path.exists(self.content_index_path):
+            with open(self.content_index_path, 'r') as f:
+                for line in f:
+                    record = json.loads(line)
+                    self.reports_by_hash[record['sha256']] = (record['report'], None)
+
+    def is_done(self, report_name):
+        return all(os.path.exists(p) for p in output_paths(self.args, report_name).values())
+
+    def log_progress(self, report_name, status, elapsed, error=''):
+        record = {'report': report_name, 'status': status, 'seconds': round(elapsed, 2), 'time': time.time()}
+        if error:
+            record['error'] = error
+        with open(self.progress_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        print('[corpus]', record)
+
+    def build_report(self, source):
+        if not is_url(source):
+            return build_report(self.args, source, pdf_store_dir=self.pdf_store_dir)
+        # urls are downloaded first, a pdf whose content was already processed under another name is not parsed
+        # and embedded again, its stored vector database and retrievals are reused
+        report_name = get_report_name(source)
+        store_path = os.path.join(self.pdf_store_dir, report_name + '.pdf')
+        content_hash = download_pdf(source, store_path)
+        with self.content_lock:
+            if content_hash not in self.reports_by_hash:
+                self.reports_by_hash[content_hash] = (report_name, threading.Event())
+            first_name, built = self.reports_by_hash[content_hash]
+        if first_name == report_name:
+            try:
+                report = self._report(report_name, store_path, lazy=False)
+                if built is not None:  # not yet in the index file
+                    with self.content_lock, open(self.content_index_path, 'a') as f:
+                        f.write(json.dumps({'sha256': content_hash, 'report': report_name}) + '\n')
+            except Exception:
+                with self.content_lock:
+                    del self.reports_by_hash[content_hash]
+                raise
+            finally:
+                if built is not None:
+                    built.set()
+            return report
+        if built is not None:
+            built.wait()
+        with self.content_lock:
+            duplicate = self.reports_by_hash.get(content_hash, (None, None))[0] == first_name
+        if not duplicate:  # parsing the first copy failed
+            return self._report(report_name, store_path, lazy=False)
+        print('[corpus] {} has the same content as {}, reusing its vector database'.format(report_name, first_name))
+        return self._report(first_name, store_path, lazy=True)
+
+    def _report(self, artifacts_name, pdf_path, lazy):
+        # the pdf is already in the store, Report does not need to save it
+        return Report(
+            path=pdf_path,
+            db_path=os.path.join(self.args.vector_db_dir, artifacts_name),
+            retrieved_chunks_path=os.path.join(self.args.retrieved_chunks_dir, artifacts_name),
+            extract_workers=self.args.extract_workers,
+            lazy=lazy,
+        )
+
+    async def analyze(self, report):
+        # a reader per report holds its results, the client (and its bound on requests in flight) is shared
+        reader = Reader(llm_name=self.args.llm_name, answer_length=str(self.args.answer_length),
+                        llm_client=self.llm_client)
+        result_qa, result_analysis = await reader.qa_and_analyze_with_chat(report_list=[report])
+        return reader, result_qa, result_analysis
+
+    async def process(self, source):
+        loop = asyncio.get_running_loop()
+        report_name = get_report_name(source)
+        start_time = time.time()
+        async with self.in_flight:
+            try:
+                report = await loop.run_in_executor(self.parse_pool, self.build_report, source)
+                async with self.llm_slots:
+                    reader, result_qa, result_analysis = await self.analyze(report)
+                write_outputs(self.args, report_name, reader, result_qa, result_analysis)
+                if self.global_index is not None:
+                    # a report reusing the vector database of a duplicate is not added twice
+                    await loop.run_in_executor(
+                        None, functools.partial(self.global_index.add_report, report_name, report.db_path,
+                                                basic_info_path=output_paths(self.args, report_name)['basic_info']))
+                self.log_progress(report_name, 'done', time.time() - start_time)
+            except Exception as e:
+                self.log_progress(report_name, 'failed', time.time() - start_time, error=str(e))
+
+    async def run(self, sources):
+        # the semaphores have to be created inside the running event loop
+        self.llm_slots = asyncio.Semaphore(self.llm_workers)
+        # parsed reports waiting for the llm stage are kept in memory, so bound how far parsing runs ahead
+        self.in_flight = asyncio.Semaphore(self.parse_workers + 2 * self.llm_workers)
+        self.llm_client = LLMClient(self.args.llm_name)
+        pending = [s for s in sources if not self.is_done(get_report_name(s))]
+        print('{} of {} reports already processed, {} to go'.format(len(sources) - len(pending), len(sources),
+                                                                  len(pending)))
+        await asyncio.gather(*[self.process(source) for source in pending])
+        self.parse_pool.shutdown()
@@ -5,27 +5,48 @@ import json
 
 import fitz, io, os
 import re
+import numpy as np
 from PIL import Image
 import cfg
 import pickle
 
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.vectorstores import FAISS, Pinecone
-from langchain.embeddings.openai import OpenAIEmbeddings
+from langchain.docstore.document import Document
 import time
+import hashlib
+import tempfile
+import threading
+import contextlib
 import requests
-import configparser
-import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from llm_client import get_api_pool, BatchEmbedder
+from embedding_cache import CachedEmbeddings
+from vector_index import build_vector_store, load_vector_store, save_vector_store, embedding_model_id
+from mapped_store import MappedVectorStore, is_mapped, load_mapped_chunks
+from retrieval_filter import RetrievalFilter
+from tracing import get_tracer
 
-config = configparser.ConfigParser()
-config.read('apikey.ini')
-chat_api_list = config.get('OpenAI', 'OPENAI_API_KEYS')[1:-1].replace('\'', '').split(',')
-os.environ["OPENAI_API_KEY"] = chat_api_list[0]
 
 TOP_K = 20
 CHUNK_SIZE = 500
 CHUNK_OVERLAP = 20
-COMPRESSION = False
+# retrieved chunks are post-processed: similarity threshold, duplicate removal (see retrieval_filter.py)
+COMPRESSION = cfg.compression
+# PyMuPDF is not thread-safe, reports built from several threads (corpus mode) take turns on fitz
+FITZ_LOCK = threading.RLock()
+# number of processes used to extract pages, 1 keeps extraction in the current process
+EXTRACT_WORKERS = 1
+# number of page ranges handed to each extraction process
+SHARDS_PER_WORKER = 4
+# stored next to the FAISS index: chunk texts and the page of every chunk (int32 array)
+CHUNKS_FILE = 'chunks.json'
+PAGE_IDX_FILE = 'page_idx.i32'
+# bytes written to disk at a time when downloading a pdf
+DOWNLOAD_BLOCK_SIZE = 1 << 20
+# connections kept open per host by the shared http session
+HTTP_POOL_SIZE = 16
 QUERIES = {
     'general': ["What is the company of the report?", "What sector does the company belong to?", "Where is the company located?",
                 #"What climate-related issues are discussed in this report?"
@@ -45,68 +66,241 @@ QUERIES = {
 
 
 class Report:
-    def __init__(self, path=None, url=None, title='', abs='', authers=[], store_path=None, top_k=TOP_K, db_path=None, retrieved_chunks_path=None):
+    def __init__(self, path=None, url=None, title='', abs='', authers=[], store_path=None, top_k=TOP_K, db_path=None, retrieved_chunks_path=None,
+                 extract_workers=EXTRACT_WORKERS, lazy=False):
+        """
+        :param lazy: do not parse anything up front, the pdf, title, chunks, retriever and retrieved sections are
+                     computed on first access (stored artifacts at db_path / retrieved_chunks_path are used if present)
+        """
         # Init the class on pdf with given path
-        self.chunks = []
-        self.page_idx = []
+        self._chunks = None
+        self._page_idx = None
+        self._pdf = None
+        self._title = None
+        self._retriever = None
+        self._vector_db = None
+        self._section_text_dict = None
+        self._lazy_lock = threading.RLock()  # a lazy attribute is computed once even if threads ask at the same time
         self.path = path  # pdf path
         self.url = url # pdf url
-        assert ((path is None and url is not None) or (path is not None and url is None)) # only need to pass in an url or a path
+        # only need to pass in an url or a path, lazy reports loaded from their artifacts may have neither
+        assert (path is None or url is None) and (lazy or path is not None or url is not None)
         self.store_path = store_path
         self.queries = QUERIES
         self.top_k = top_k  # retriever top-k
         self.compression = COMPRESSION
+        self.retrieval_filter = RetrievalFilter() if self.compression else None
         self.section_names = []  # title
         self.section_texts = {}  # content
         self.db_path = db_path # set self.db_path
         self.retrieved_chunks_path = retrieved_chunks_path
-        if title == '':
-            if self.path:
-                self.pdf = fitz.open(self.path)  # pdf
-                #self.parse_pdf_from_url(self.url)
-            else:
-                self.parse_pdf_from_url(self.url)  # download from an URL
-                #self.pdf = fitz.open(self.path)
-            self.title = self.get_title()
-            self.parse_pdf()
-        else:
+        self.pages = None  # per-page records, filled once by extract_pages
+        self.extract_workers = extract_workers
+        self.content_hash = None  # sha256 of the pdf when it was downloaded
+        self._download_dir = None  # temporary directory of a download without store_path
+        self.timings = {}  # seconds spent in each ingest stage
+        # tags the spans of the report, the pdf name (or the vector database directory of a report from artifacts)
+        self.report_id = os.path.basename(path or url or db_path or '').replace('.pdf', '')
+        self.context_blocks = {}  # retrieval key -> chunks rendered for the prompts, filled by the Reader
+        self.basic_info = None  # basic info string of the user QA prompt, kept once UserQA knows it
+        if title != '':
             self.title = title
+        elif not lazy:
+            # pages are extracted by parse_pdf, chunks are embedded while later pages are extracted
+            self.parse_pdf()
         self.authers = authers
         self.abs = abs
         self.roman_num = ["I", "II", 'III', "IV", "V", "VI", "VII", "VIII", "IIX", "IX", "X"]
         self.digit_num = [str(d + 1) for d in range(10)]
         self.first_image = ''
 
-    def parse_pdf_from_url(self, url):
-        response = requests.get(url)
-        pdf = io.BytesIO(response.content)
-        self.pdf = fitz.open(stream=pdf)
+    @contextlib.contextmanager
+    def _stage(self, stage, **attributes):
+        """ span of an ingest stage, its seconds are kept in self.timings as well """
+        start_time = time.time()
+        try:
+            with get_tracer().span(stage, report=self.report_id, **attributes) as span:
+                yield span
+        finally:
+            self.timings[stage] = time.time() - start_time
 
-    def parse_pdf(self):
-        if self.path:
-            self.pdf = fitz.open(self.path)  # pdf
+    @classmethod
+    def from_artifacts(cls, db_path, retrieved_chunks_path=None, title='', top_k=TOP_K):
+        """
+        report of an already processed pdf, built from its vector database (chunks, pages) and retrieved.json only;
+        the pdf is never opened
+        """
+        return cls(title=title, top_k=top_k, db_path=db_path, retrieved_chunks_path=retrieved_chunks_path,
+                   lazy=True)
+
+    @property
+    def pdf(self):
+        if self._pdf is None:
+            with self._lazy_lock:
+                if self._pdf is None:
+                    assert self.path is not None or self.url is not None, "report loaded from artifacts has no pdf"
+                    with self._stage('open'):
+                        if self.path:
+                            with FITZ_LOCK:
+                                self._pdf = fitz.open(self.path)  # pdf
+                        else:
+                            self.parse_pdf_from_url(self.url)  # download from an URL
+        return self._pdf
+
+    @pdf.setter
+    def pdf(self, pdf):
+        self._pdf = pdf
+
+    @property
+    def title(self):
+        if self._title is None:
+            with self._lazy_lock:
+                if self._title is None:
+                    if self.path is None and self.url is None:
+                        self._title = ''  # not known without the pdf
+                    else:
+                        with self._stage('title'):
+                            self._title = self.get_title()
+        return self._title
+
+    @title.setter
+    def title(self, title):
+        self._title = title
+
+    @property
+    def chunks(self):
+        if self._chunks is None:
+            with self._lazy_lock:
+                if self._chunks is None:
+                    self._chunks, self._page_idx = self._get_chunks()
+        return self._chunks
+
+    @property
+    def page_idx(self):
+        if self._page_idx is None:
+            with self._lazy_lock:
+                if self._page_idx is None:
+                    self._chunks, self._page_idx = self._get_chunks()
+        return self._page_idx
+
+    @property
+    def retriever(self):
+        if self._retriever is None:
+            with self._lazy_lock:
+                if self._retriever is None:
+                    self._retriever, self._vector_db = self._get_retriever(self.db_path)
+        return self._retriever
+
+    @retriever.setter
+    def retriever(self, retriever):
+        self._retriever = retriever
+
+    @property
+    def vector_db(self):
+        if self._vector_db is None:
+            with self._lazy_lock:
+                if self._vector_db is None:
+                    self._retriever, self._vector_db = self._get_retriever(self.db_path)
+        return self._vector_db
+
+    @vector_db.setter
+    def vector_db(self, vector_db):
+        self._vector_db = vector_db
+
+    @property
+    def section_text_dict(self):
+        if self._section_text_dict is None:
+            with self._lazy_lock:
+                if self._section_text_dict is None:
+                    self._section_text_dict = self._load_retrieved_chunks()
+                    if self._section_text_dict is None:
+                        with self._stage('retrieval'):
+                            self._section_text_dict = self._retrieve_chunks()
+                        self._save_retrieved_chunks()
+        return self._section_text_dict
+
+    @section_text_dict.setter
+    def section_text_dict(self, section_text_dict):
+        self._section_text_dict = section_text_dict
+
+    def parse_pdf_from_url(self, url):
+        # the download is spooled to store_path (or a temporary file), fitz then reads the file rather than a copy
+        # in memory, and parse_pdf does not need to save it again
+        if self.store_path is not None:
+            path = self.store_path
         else:
-            self.parse_pdf_from_url(self.url) # download from an URL
-        self.text_list = [page.get_text() for page in self.pdf]
+            # owned by the report, removed with it (or at exit)
+            self._download_dir = tempfile.TemporaryDirectory(prefix='report_')
+            path = os.path.join(self._download_dir.name, 'report.pdf')
+        self.content_hash = download_pdf(url, path)
+        self.path = path
+        with FITZ_LOCK:
+            self._pdf = fitz.open(self.path)
+
+    def extract_pages(self, on_page=None):
+        """
+        extract every page once and cache the result, so that title detection, chunking and retrieval
+        do not have to go back to fitz
+        :param on_page: called with every page record as soon as it is extracted, in page order
+        :return: list of page records with keys 'page' (1-based number), 'text' and 'spans'
+        """
+        if self.pages is not None:
+            return self.pages
+        pdf = self.pdf  # opened outside of the extract stage
+        with self._stage('extract') as span:
+            with FITZ_LOCK:
+                num_pages = len(pdf)
+            span.set(pages=num_pages)
+            if self.extract_workers > 1 and num_pages >= 2 * self.extract_workers:
+                records = self._extract_pages_parallel(num_pages)
+            else:
+                records = self._extract_pages_serial(pdf, num_pages)
+            pages = []
+            for record in records:
+                pages.append(record)
+                if on_page is not None:
+                    on_page(record)
+            self.pages = pages
+        self.text_list = [record['text'] for record in self.pages]
         self.all_text = ' '.join(self.text_list)
+        return self.pages
+
+    @staticmethod
+    def _extract_pages_serial(pdf, num_pages):
+        # FITZ_LOCK is taken page by page, reports of other threads get their turns in between, and the callbacks
+        # of extract_pages run without it
+        for i in range(num_pages):
+            with FITZ_LOCK:
+                record = _extract_page(pdf[i], i + 1)
+            yield record
+
+    def _extract_pages_parallel(self, num_pages):
+        # every worker opens its own fitz handle on the same document and extracts a contiguous page range, no
+        # FITZ_LOCK needed; yields the page records in page order, a range as soon as it and all before it are done
+        num_shards = min(num_pages, self.extract_workers * SHARDS_PER_WORKER)
+        bounds = [num_pages * i // num_shards for i in range(num_shards + 1)]
+        with ProcessPoolExecutor(max_workers=self.extract_workers) as executor:
+            futures = [executor.submit(_extract_page_range, self.path, start, end)
+                       for start, end in zip(bounds[:-1], bounds[1:])]
+            for future in futures:  # futures are kept in page order
+                yield from future.result()
+
+    def parse_pdf(self):
         # self.section_page_dict = self._get_all_page_index() # paragraph and page map
         # print("section_page_dict", str(self.section_page_dict))
         # self.section_text_dict = self._get_all_page() # paragraph and content
         start_time = time.time()
         # _get_retriever load/store database from/to self.db_path
         self.retriever, self.vector_db = self._get_retriever(self.db_path)
-        self.section_text_dict = self._retrieve_chunks()
-        if not os.path.exists(self.retrieved_chunks_path):
-            os.makedirs(self.retrieved_chunks_path)
-        with open(os.path.join(self.retrieved_chunks_path, 'retrieved.json'), 'w') as f:
-            to_dump = {
-                key: {chunk.metadata['source']: [chunk.page_content, chunk.metadata['page']] for chunk in chunk_list}
-                for key, chunk_list in self.section_text_dict.items()
-            }
-            json.dump(to_dump, f)
+        with self._stage('retrieval'):
+            self.section_text_dict = self._retrieve_chunks()
+        self._save_retrieved_chunks()
 
         end_time = time.time()
         print('time for retrieval:', end_time - start_time)
+        print('ingest timings:', {stage: round(t, 3) for stage, t in self.timings.items()})
+        if self.retrieval_filter is not None:
+            print('retrieval filter:', self.retrieval_filter.stats())
         self.section_text_dict.update({"title": self.title})
         # whether this is a valid pdf (use keyword to check)
         store_flag = True
@@ -114,9 +308,35 @@ class Report:
         #     if len(self.section_text_dict[topic]) > 0:
         #         store_flag = True
         #         break
-        if self.store_path is not None and store_flag:
-            self.pdf.save(self.store_path)
-        self.pdf.close()
+        with FITZ_LOCK:
+            if self.store_path is not None and store_flag and self.path != self.store_path:
+                self.pdf.save(self.store_path)
+            self.pdf.close()
+
+    def _save_retrieved_chunks(self):
+        if self.retrieved_chunks_path is None:
+            return
+        if not os.path.exists(self.retrieved_chunks_path):
+            os.makedirs(self.retrieved_chunks_path)
+        with open(os.path.join(self.retrieved_chunks_path, 'retrieved.json'), 'w') as f:
+            to_dump = {
+                key: {chunk.metadata['source']: [chunk.page_content, chunk.metadata['page']] for chunk in chunk_list}
+                for key, chunk_list in self.section_text_dict.items() if key != 'title'
+            }
+            json.dump(to_dump, f)
+
+    def _load_retrieved_chunks(self):
+        """ sections retrieved by an earlier run (retrieved.json), None if there are none """
+        if self.retrieved_chunks_path is None:
+            return None
+        path = os.path.join(self.retrieved_chunks_path, 'retrieved.json')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            retrieved = json.load(f)
+        return {key: [Document(page_content=content, metadata={'source': source, 'page': page})
+                      for source, (content, page) in chunks.items()]
+                for key, chunks in retrieved.items()}
 
     def get_image_path(self, image_path=''):
         """
@@ -175,12 +395,7 @@ class Report:
 
     # recongnize the title by fontsize
     def get_chapter_names(self, ):
-        # # open pdf
-        doc = fitz.open(self.path)
-        text_list = [page.get_text() for page in doc]
-        all_text = ''
-        for text in text_list:
-            all_text += text
+        all_text = ''.join(record['text'] for record in self.extract_pages())
         # # create the list to store all the names
         chapter_names = []
         for line in all_text.split('\n'):
@@ -197,43 +412,31 @@ class Report:
         return chapter_names
 
     def get_title(self):
-        doc = self.pdf
+        pages = self.extract_pages()
         max_font_size = 0  # init fontsize 0
         max_string = ""  # init max string
         max_font_sizes = [0]
-        for page in doc:  # go through all pages
-            text = page.get_text("dict")  # acquire the info in the page
-            blocks = text["blocks"]  # acquire text block
-            for block in blocks:  # go through all blocks
-                if block["type"] == 0 and len(block['lines']):  # if str
-                    if len(block["lines"][0]["spans"]):
-                        font_size = block["lines"][0]["spans"][0]["size"]  # acquire fontsize
-                        max_font_sizes.append(font_size)
-                        if font_size > max_font_size:
-                            max_font_size = font_size  # update max fontsize
-                            max_string = block["lines"][0]["spans"][0]["text"]  # update the title str
+        for record in pages:  # go through all pages
+            for font_size, font_flags, cur_string in record['spans']:  # first span of every text block
+                max_font_sizes.append(font_size)
+                if font_size > max_font_size:
+                    max_font_size = font_size  # update max fontsize
+                    max_string = cur_string  # update the title str
         max_font_sizes.sort()
         print("max_font_sizes", max_font_sizes[-10:])
         cur_title = ''
-        for page in doc:  # go through all pages
-            text = page.get_text("dict")
-            blocks = text["blocks"]
-            for block in blocks:
-                if block["type"] == 0 and len(block['lines']):
-                    if len(block["lines"][0]["spans"]):
-                        cur_string = block["lines"][0]["spans"][0]["text"]
-                        font_flags = block["lines"][0]["spans"][0]["flags"]
-                        font_size = block["lines"][0]["spans"][0]["size"]
-                        # print(font_size)
-                        if abs(font_size - max_font_sizes[-1]) < 0.3 or abs(font_size - max_font_sizes[-2]) < 0.3:
-                            # print("The string is bold.", max_string, "font_size:", font_size, "font_flags:", font_flags)
-                            if len(cur_string) > 4:
-                                # print("The string is bold.", max_string, "font_size:", font_size, "font_flags:", font_flags)
-                                if cur_title == '':
-                                    cur_title += cur_string
-                                else:
-                                    cur_title += ' ' + cur_string
-                                    # break
+        for record in pages:  # go through all pages
+            for font_size, font_flags, cur_string in record['spans']:
+                # print(font_size)
+                if abs(font_size - max_font_sizes[-1]) < 0.3 or abs(font_size - max_font_sizes[-2]) < 0.3:
+                    # print("The string is bold.", max_string, "font_size:", font_size, "font_flags:", font_flags)
+                    if len(cur_string) > 4:
+                        # print("The string is bold.", max_string, "font_size:", font_size, "font_flags:", font_flags)
+                        if cur_title == '':
+                            cur_title += cur_string
+                        else:
+                            cur_title += ' ' + cur_string
+                            # break
         title = cur_title.replace('\n', ' ')
         return title
 
@@ -261,7 +464,7 @@ class Report:
         text = ''
         text_list = []
         section_dict = {}
-        text_list = [page.get_text() for page in self.pdf]
+        text_list = [record['text'] for record in self.extract_pages()]
         for sec_index, sec_name in enumerate(self.section_page_dict):
             cur_sec_text = ''
             for page_i in self.section_page_dict[sec_name]:
@@ -270,8 +473,30 @@ class Report:
         return section_dict
 
     # _get_retriever load/store database from/to self.db_path
-    def _get_retriever(self, db_path):
-        embeddings = OpenAIEmbeddings()
+    def _get_chunks(self):
+        """
+        :return: (chunk texts, page number of every chunk), loaded from the files stored with the vector database
+                 when there are any, so that the pdf is not needed
+        """
+        if self.db_path is not None and (os.path.exists(os.path.join(self.db_path, PAGE_IDX_FILE)) or
+                                         is_mapped(self.db_path)):
+            return load_chunks(self.db_path)
+        if self._vector_db is not None or (self.db_path is not None and os.path.exists(self.db_path)):
+            # index stored before chunks were saved with it, take them from its docstore and save them for next time
+            docstore = self.vector_db.docstore
+            docs = [docstore.search(doc_id) for doc_id in self.vector_db.index_to_docstore_id.values()]
+            docs.sort(key=lambda doc: int(doc.metadata['source']))
+            chunks = [doc.page_content for doc in docs]
+            page_idx = array('i', [int(doc.metadata['page']) for doc in docs])
+            save_chunks(self.db_path, chunks, page_idx)
+            return chunks, page_idx
+        return self._split_chunks()
+
+    def _split_chunks(self, embedder=None):
+        """
+        :param embedder: BatchEmbedder the chunks are handed to as they are split; pages not extracted yet are then
+                         split (and their chunks sent for embedding) one by one during extraction
+        """
         text_splitter = RecursiveCharacterTextSplitter(
             # split by ["\n\n", "\n", " "].
             chunk_size=CHUNK_SIZE,
@@ -279,35 +504,225 @@ class Report:
             length_function=len,
             separators=["\n\n", "\n", " "],
         )
-        text_list = [page.get_text() for page in self.pdf]
-        full_text = '\n\n'.join(text_list)
-        for i, page in enumerate(self.pdf):
-            page_chunks = text_splitter.split_text(page.get_text())
-            self.page_idx.extend([i + 1] * len(page_chunks))
-            self.chunks.extend(page_chunks)
+        chunks = []
+        page_idx = array('i')
+
+        def split_page(record):
+            page_chunks = text_splitter.split_text(record['text'])
+            page_idx.extend([record['page']] * len(page_chunks))
+            chunks.extend(page_chunks)
+            if embedder is not None:
+                embedder.add(page_chunks)
+
+        if self.pages is None and embedder is not None:
+            # chunking is part of the extract stage
+            self.extract_pages(on_page=split_page)
+            return chunks, page_idx
+        pages = self.extract_pages()
+        with self._stage('chunking') as span:
+            for record in pages:
+                split_page(record)
+            span.set(chunks=len(chunks))
+        return chunks, page_idx
+
+    # _get_retriever load/store database from/to self.db_path
+    def _get_retriever(self, db_path):
+        embeddings = get_embeddings()
+        self.embeddings = embeddings
         if os.path.exists(db_path):
-            doc_search = FAISS.load_local(db_path, embeddings=embeddings)
+            with self._stage('embedding', loaded=True):
+                doc_search = load_vector_store(db_path, embeddings)
         else:
-            doc_search = FAISS.from_texts(self.chunks, embeddings,
-                                          metadatas=[{"source": str(i), "page": str(page_idx)} for i, page_idx in
-                                                     enumerate(self.page_idx)])
+            # chunks are embedded in concurrent batches as they are produced; a report not chunked yet is split page
+            # by page during extraction, so embedding starts with its first pages
+            with BatchEmbedder(embeddings) as embedder:
+                split_now = self._chunks is None
+                if split_now:
+                    self._chunks, self._page_idx = self._split_chunks(embedder)
+                chunks, page_idx = self._chunks, self._page_idx
+                # what is left of the embedding once the chunks are split, and the index
+                with self._stage('embedding', chunks=len(chunks)) as span:
+                    if not split_now:
+                        embedder.add(chunks)
+                    # index type from cfg.faiss_index_type
+                    doc_search = build_vector_store(chunks, embeddings,
+                                                    metadatas=[{"source": str(i), "page": str(page)} for i, page in
+                                                               enumerate(page_idx)],
+                                                    vectors=embedder.result())
 
-            doc_search.save_local(db_path)
+                    save_vector_store(doc_search, db_path, embeddings)
+                    save_chunks(db_path, chunks, page_idx)
+                    if cfg.use_embedding_cache:
+                        span.set(cache_hits=embeddings.stats()['from_cache'])
+                        print('embedding cache:', embeddings.stats())
         retriever = doc_search.as_retriever(search_kwargs={"k": self.top_k})
 
         return retriever, doc_search
 
+    def _search(self, query_texts, k):
+        """
+        embed all queries with one batched request and search them against the index as one matrix
+        :return: list with the top-k (document, distance) pairs of every query
+        """
+        vector_db = self.vector_db  # loads the index and its embeddings on first use
+        return self._search_vectors(vector_db, _embed_queries(self.embeddings, query_texts), k)
+
+    def _search_vectors(self, vector_db, query_vectors, k):
+        if isinstance(vector_db, MappedVectorStore):
+            return vector_db.search_vectors(query_vectors, k)
+        distances, indices = vector_db.index.search(query_vectors, k)
+        results = []
+        for row_distances, row_indices in zip(distances, indices):
+            docs = []
+            for distance, i in zip(row_distances, row_indices):
+                if i == -1:  # fewer chunks than k
+                    continue
+                docs.append((vector_db.docstore.search(vector_db.index_to_docstore_id[i]), float(distance)))
+            results.append(docs)
+        return results
+
+    def _filter(self, results):
+        return self._filter_merged([results])
+
+    def _filter_merged(self, result_lists):
+        """ the results of several queries as one list, a chunk retrieved by more than one of them is kept once """
+        if self.retrieval_filter is not None:
+            return self.retrieval_filter.filter_merged(result_lists)
+        docs = []
+        sources = set()
+        for results in result_lists:
+            for doc, _ in results:
+                if doc.metadata['source'] not in sources:
+                    sources.add(doc.metadata['source'])
+                    docs.append(doc)
+        return docs
+
+    def retrieve(self, query, k=None):
+        """ chunks retrieved for a (user) question, post-processed like the chunks of the fixed queries """
+        vector_db = self.vector_db  # loads the index and its embeddings on first use
+        with get_tracer().span('retrieve', report=self.report_id):
+            # not through _embed_queries, which keeps the vectors of the fixed queries for the lifetime of the process
+            query_vector = np.asarray([self.embeddings.embed_query(query)], dtype=np.float32)
+            return self._filter(self._search_vectors(vector_db, query_vector, k or self.top_k)[0])
+
     def _retrieve_chunks(self):
-        section_text_dict = {}
-        for key in self.queries.keys():
-            if key == 'general':
-                docs_1 = self.retriever.get_relevant_documents(self.queries[key][0])[:5]
-                docs_2 = self.retriever.get_relevant_documents(self.queries[key][1])[:5]
-                docs_3 = self.retriever.get_relevant_documents(self.queries[key][2])[:5]
-                section_text_dict[key] = docs_1 + docs_2 + docs_3
-            else:
-                section_text_dict[key] = self.retriever.get_relevant_documents(self.queries[key])
-        return section_text_dict
+        keys = []
+        query_texts = []
+        for key, query in self.queries.items():
+            for q in (query if isinstance(query, list) else [query]):
+                keys.append(key)
+                query_texts.append(q)
+        results = {}
+        for key, docs in zip(keys, self._search(query_texts, self.top_k)):
+            # top 5 of each of the basic info queries, filtered query by query; chunks found by several of them
+            # are kept once
+            results.setdefault(key, []).append(docs[:5] if key == 'general' else docs)
+        return {key: self._filter_merged(result_lists) for key, result_lists in results.items()}
+
+
+def get_embeddings():
+    """ the embedding model of the vector databases (cfg.embedding_backend), behind the embedding cache if enabled """
+    if cfg.embedding_backend == 'local':
+        from local_embeddings import get_local_embeddings  # sentence-transformers is only needed for it
+        embeddings = get_local_embeddings()
+    else:
+        embeddings = get_api_pool().embeddings()
+    if cfg.use_embedding_cache:
+        embeddings = CachedEmbeddings(embeddings, model_id=embeddings.model)
+    return embeddings
+
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session():
+    """ the process-wide session, connections are pooled across the downloads of a batch of urls """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_session = session
+    return _http_session
+
+
+def download_pdf(url, path, timeout=60):
+    """
+    stream url to path block by block, the document is never held in memory as a whole
+    :return: sha256 hex digest of the content
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    # written under a temporary name, so that an interrupted download never looks like a complete pdf
+    fd, part_path = tempfile.mkstemp(suffix='.part', dir=directory or None)
+    try:
+        with os.fdopen(fd, 'wb') as f, get_http_session().get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            for block in response.iter_content(DOWNLOAD_BLOCK_SIZE):
+                f.write(block)
+                digest.update(block)
+        os.replace(part_path, path)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    return digest.hexdigest()
+
+
+def save_chunks(db_path, chunks, page_idx):
+    # a mapped vector database has the texts in its text blob already
+    if not is_mapped(db_path):
+        with open(os.path.join(db_path, CHUNKS_FILE), 'w') as f:
+            json.dump(chunks, f)
+    with open(os.path.join(db_path, PAGE_IDX_FILE), 'wb') as f:
+        array('i', page_idx).tofile(f)
+
+
+def load_chunks(db_path):
+    """ :return: chunk texts and their pages as stored by save_chunks """
+    if not os.path.exists(os.path.join(db_path, CHUNKS_FILE)):
+        texts, pages = load_mapped_chunks(db_path)
+        return list(texts), array('i', pages)
+    with open(os.path.join(db_path, CHUNKS_FILE), 'r') as f:
+        chunks = json.load(f)
+    page_idx = array('i')
+    with open(os.path.join(db_path, PAGE_IDX_FILE), 'rb') as f:
+        page_idx.fromfile(f, len(chunks))
+    return chunks, page_idx
+
+
+_query_vectors = {}
+
+
+def _embed_queries(embeddings, query_texts):
+    # the fixed queries are the same for every report, they are embedded once per process (and model)
+    key = (embedding_model_id(embeddings), tuple(query_texts))
+    if key not in _query_vectors:
+        _query_vectors[key] = np.asarray(embeddings.embed_documents(list(query_texts)), dtype=np.float32)
+    return _query_vectors[key]
+
+
+def _extract_page(page, page_number):
+    # one TextPage feeds both the plain text and the font information; built with the flags of get_text("dict"),
+    # which are those of get_text() plus image blocks (skipped by the plain text), so both match the fitz defaults
+    textpage = page.get_textpage(flags=fitz.TEXTFLAGS_DICT)
+    spans = []
+    for block in page.get_text("dict", textpage=textpage)["blocks"]:
+        if block["type"] == 0 and len(block['lines']) and len(block["lines"][0]["spans"]):
+            span = block["lines"][0]["spans"][0]
+            spans.append((span["size"], span["flags"], span["text"]))
+    return {'page': page_number, 'text': page.get_text(textpage=textpage), 'spans': spans}
+
+
+def _extract_page_range(path, start, end):
+    # executed in a worker process
+    with fitz.open(path) as doc:
+        return [_extract_page(doc[i], i + 1) for i in range(start, end)]
 
 
 def search_page(content, search_list):
@@ -0,0 +1,172 @@
+"""
+ on-disk store of chunk embeddings keyed on the chunk text, shared across reports, years and re-chunkings
+"""
+import os
+import json
+import math
+import hashlib
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+import cfg
+
+try:
+    import fcntl
+except ImportError:  # no inter-process locking on Windows
+    fcntl = None
+
+
+def text_key(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+@contextmanager
+def _file_lock(path):
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class EmbeddingStore:
+    """
+    append-only map from text hash to vector for one embedding model:
+    keys.txt holds one hash per line, vectors.f32 the float32 rows in the same order (memory-mapped for reading)
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.keys_path = os.path.join(directory, 'keys.txt')
+        self.vectors_path = os.path.join(directory, 'vectors.f32')
+        self.meta_path = os.path.join(directory, 'meta.json')
+        self.lock_path = os.path.join(directory, '.lock')
+        self.index = {}  # text hash -> row
+        self.dim = None
+        self._keys_offset = 0
+        self._vectors = None
+        self._lock = threading.Lock()
+        self._refresh()
+
+    def _refresh(self):
+        # pick up rows appended by other processes since the last look
+        if self.dim is None and os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as f:
+                self.dim = json.load(f)['dim']
+        if not os.path.exists(self.keys_path):
+            return
+        with open(self.keys_path, 'rb') as f:
+            f.seek(self._keys_offset)
+            data = f.read()
+        # only complete lines, another process may be writing the last one
+        data = data[:data.rfind(b'\n') + 1]
+        for key in data.decode('ascii').splitlines():
+            self.index[key] = len(self.index)
+        self._keys_offset += len(data)
+
+    def _matrix(self):
+        if self._vectors is None or self._vectors.shape[0] != len(self.index):
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(len(self.index), self.dim))
+        return self._vectors
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, keys):
+        """ :return: dict from the keys found in the store to their vectors """
+        with self._lock:
+            self._refresh()
+            found = [k for k in keys if k in self.index]
+            if not found:
+                return {}
+            vectors = self._matrix()
+            return {k: vectors[self.index[k]].tolist() for k in found}
+
+    def add(self, keys, vectors):
+        with self._lock, _file_lock(self.lock_path):
+            self._refresh()
+            new_rows = {}
+            for key, vector in zip(keys, vectors):
+                if key not in self.index and key not in new_rows:
+                    new_rows[key] = vector
+            if not new_rows:
+                return
+            if self.dim is None:
+                self.dim = len(next(iter(new_rows.values())))
+                with open(self.meta_path, 'w') as f:
+                    json.dump({'dim': self.dim}, f)
+            with open(self.vectors_path, 'ab') as f:
+                # drop rows of a writer that died before registering their keys
+                f.truncate(len(self.index) * self.dim * 4)
+                f.write(np.asarray(list(new_rows.values()), dtype=np.float32).tobytes())
+                f.flush()
+            # keys are written last, a key is never visible before its vector
+            with open(self.keys_path, 'ab') as f:
+                f.write(''.join(k + '\n' for k in new_rows).encode('ascii'))
+            self._refresh()
+
+
+class CachedEmbeddings(Embeddings):
+    """ wraps an embedding backend, chunks already embedded by the same model are taken from the store """
+
+    def __init__(self, embeddings, model_id, cache_dir=cfg.embedding_cache_dir):
+        self.embeddings = embeddings
+        self.model_id = model_id
+        self.store = _get_store(os.path.join(cache_dir, model_id.replace('/', '_')))
+        # batches of the backend in flight at a time, several batches may be looked up here concurrently
+        self.concurrency = getattr(embeddings, 'concurrency', 1)
+        self.num_requested = 0
+        self.num_cached = 0
+        self.num_embedded = 0
+        self.api_calls_saved = 0
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        keys = [text_key(t) for t in texts]
+        found = self.store.get(keys)
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        if missing:
+            new_vectors = self.embeddings.embed_documents(list(missing.values()))
+            self.store.add(list(missing.keys()), new_vectors)
+            found.update(zip(missing.keys(), new_vectors))
+        # requests are counted per batch_size texts, no texts are tokenized for the stat; exact for callers that
+        # send token-bounded batches one call at a time (BatchEmbedder)
+        batch_size = getattr(self.embeddings, 'batch_size', 1)
+        calls_saved = math.ceil(len(texts) / batch_size) - math.ceil(len(missing) / batch_size)
+        with self._lock:
+            self.num_requested += len(texts)
+            self.num_cached += len(texts) - len(missing)
+            self.num_embedded += len(missing)
+            self.api_calls_saved += calls_saved
+        return [found[k] for k in keys]
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
+
+    def stats(self):
+        with self._lock:
+            return {'requested': self.num_requested, 'from_cache': self.num_cached, 'embedded': self.num_embedded,
+                    'api_calls_saved': self.api_calls_saved, 'stored': len(self.store)}
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def _get_store(directory):
+    # one store object per directory and process, so threads share the index
+    with _stores_lock:
+        if directory not in _stores:
+            _stores[directory] = EmbeddingStore(directory)
+        return _stores[directory]
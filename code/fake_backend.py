@@ -0,0 +1,222 @@
+"""
+ offline stand-in for the OpenAI api (cfg.llm_backend = 'fake'): chat / completion requests get canned JSON answers
+ in the format every prompt asks for, embeddings are hashed bags of words. Latency, server-side rate limits,
+ transient errors, context-length rejections and prompt-prefix caching are simulated, so the whole pipeline (parsing,
+ embedding, retrieval, QA, assessment) can be run and timed without keys or network. Answers are meaningless,
+ the requests sent and the tokens they carry are the same as with the real api
+"""
+import re
+import json
+import time
+import random
+import asyncio
+import hashlib
+import threading
+from collections import deque
+
+import numpy as np
+import openai
+from langchain.schema import LLMResult, Generation, ChatGeneration, AIMessage
+
+import cfg
+from llm_client import APIKeyPool, PooledEmbeddings, RATE_WINDOW, count_tokens, get_encoder, message_tokens
+from context_packer import context_window
+
+# the server caches prompt prefixes of at least this many tokens, in steps of PREFIX_CACHE_BLOCK tokens
+PREFIX_CACHE_MIN_TOKENS = 1024
+PREFIX_CACHE_BLOCK = 128
+# sources cited by a fake answer
+NUM_SOURCES = 3
+
+
+def _message_text(message):
+    # message is either a completion prompt or a list of chat messages
+    if isinstance(message, str):
+        return message
+    return '\n'.join('{}: {}'.format(m.type, m.content) for m in message)
+
+
+def _canned_answer(prompt):
+    """ :return: JSON answer with the keys the prompt asks for """
+    if 'COMPANY_SECTOR, and COMPANY_LOCATION' in prompt:
+        return {'COMPANY_NAME': 'Fake Company', 'COMPANY_SECTOR': 'Fake sector', 'COMPANY_LOCATION': 'Fake location'}
+    if '2. SCORE:' in prompt:
+        return {'ANALYSIS': 'Offline answer, the disclosure was not analysed.', 'SCORE': 50}
+    if "'SCORES'" in prompt:
+        question_number = re.search(r'contains (\d+)', prompt)
+        return {'COMMENT': 'Offline answer, the report was not assessed.',
+                'SCORES': [0.5] * (int(question_number.group(1)) if question_number else 1)}
+    sources = [int(s) for s in re.findall(r'Source: (\d+)', prompt)][:NUM_SOURCES]
+    if '1. SUMMARY:' in prompt:
+        return {'SUMMARY': 'Offline answer, the disclosure was not summarised.', 'SOURCES': sources}
+    return {'ANSWER': 'Offline answer, the question was not answered.', 'SOURCES': sources}
+
+
+class FakeServer:
+    """ server-side behaviour shared by all fake keys: rate limits, errors, prefix cache and request counts """
+
+    def __init__(self, rpm_limit=cfg.fake_rpm_limit, error_rate=cfg.fake_error_rate, seed=cfg.fake_seed):
+        """
+        :param rpm_limit: chat requests per minute and key before the server answers 429, 0 for no limit
+        :param error_rate: share of chat requests failing with a transient server error
+        """
+        self.rpm_limit = rpm_limit
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._windows = {}  # api key -> timestamps of its requests within the last RATE_WINDOW seconds
+        self._prefixes = set()  # hashes of the cached prompt prefixes
+        self._lock = threading.Lock()
+        self.num_requests = 0
+        self.num_rate_limited = 0
+        self.num_errors = 0
+        self.num_context_rejected = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self.num_embedding_requests = 0
+        self.num_embedded_texts = 0
+
+    def admit(self, api_key):
+        """ raise the error the real api would answer a chat request with, if any """
+        with self._lock:
+            self.num_requests += 1
+            if self.rpm_limit:
+                now = time.time()
+                window = self._windows.setdefault(api_key, deque())
+                while window and window[0] <= now - RATE_WINDOW:
+                    window.popleft()
+                if len(window) >= self.rpm_limit:
+                    self.num_rate_limited += 1
+                    wait = window[0] + RATE_WINDOW - now
+                    raise openai.error.RateLimitError('Rate limit reached for requests (fake backend)',
+                                                      headers={'retry-after': '{:.3f}'.format(wait)})
+                window.append(now)
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.num_errors += 1
+                raise openai.error.ServiceUnavailableError('The server is overloaded (fake backend)')
+
+    def reject_context(self):
+        with self._lock:
+            self.num_context_rejected += 1
+
+    def cache_prefix(self, tokens):
+        """ :return: number of leading tokens served from the prefix cache, the prefixes of tokens are cached after """
+        if len(tokens) < PREFIX_CACHE_MIN_TOKENS:
+            return 0
+        prefix_hash = hashlib.md5()
+        hashes = []
+        for start in range(0, len(tokens) - PREFIX_CACHE_BLOCK + 1, PREFIX_CACHE_BLOCK):
+            prefix_hash.update(repr(tokens[start:start + PREFIX_CACHE_BLOCK]).encode('utf-8'))
+            if start + PREFIX_CACHE_BLOCK >= PREFIX_CACHE_MIN_TOKENS:
+                hashes.append((start + PREFIX_CACHE_BLOCK, prefix_hash.hexdigest()))
+        with self._lock:
+            cached = max([length for length, h in hashes if h in self._prefixes], default=0)
+            self._prefixes.update(h for _, h in hashes)
+        return cached
+
+    def record(self, prompt_tokens, cached_tokens, completion_tokens):
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.cached_tokens += cached_tokens
+            self.completion_tokens += completion_tokens
+
+    def record_embeddings(self, num_texts):
+        with self._lock:
+            self.num_embedding_requests += 1
+            self.num_embedded_texts += num_texts
+
+    def stats(self):
+        with self._lock:
+            return {'requests': self.num_requests, 'rate_limited': self.num_rate_limited, 'errors': self.num_errors,
+                    'context_rejected': self.num_context_rejected, 'prompt_tokens': self.prompt_tokens,
+                    'cached_tokens': self.cached_tokens, 'completion_tokens': self.completion_tokens,
+                    'embedding_requests': self.num_embedding_requests, 'embedded_texts': self.num_embedded_texts}
+
+
+class FakeLLM:
+    """ answers the agenerate calls LLMClient makes on a langchain model """
+
+    def __init__(self, server, api_key, llm_name, max_tokens=512, latency=cfg.fake_llm_latency,
+                 latency_per_1k_tokens=cfg.fake_llm_latency_per_1k_tokens):
+        self.server = server
+        self.api_key = api_key
+        self.llm_name = llm_name
+        self.max_tokens = max_tokens
+        self.latency = latency
+        self.latency_per_1k_tokens = latency_per_1k_tokens
+        self.encoder = get_encoder(llm_name)
+
+    async def agenerate(self, messages):
+        message = messages[0]
+        self.server.admit(self.api_key)
+        prompt_tokens = message_tokens(message)
+        window = context_window(self.llm_name)
+        if prompt_tokens + self.max_tokens > window:
+            self.server.reject_context()
+            raise openai.error.InvalidRequestError(
+                "This model's maximum context length is {} tokens. However, you requested {} tokens "
+                "(fake backend)".format(window, prompt_tokens + self.max_tokens), 'messages')
+        prompt = _message_text(message)
+        cached_tokens = min(self.server.cache_prefix(self.encoder.encode(prompt)), prompt_tokens)
+        await asyncio.sleep(self.latency + self.latency_per_1k_tokens * prompt_tokens / 1000.)
+        output_text = json.dumps(_canned_answer(prompt))
+        completion_tokens = count_tokens(output_text)
+        self.server.record(prompt_tokens, cached_tokens, completion_tokens)
+        generation = Generation(text=output_text) if isinstance(message, str) else \
+            ChatGeneration(message=AIMessage(content=output_text))
+        token_usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                       'total_tokens': prompt_tokens + completion_tokens,
+                       'prompt_tokens_details': {'cached_tokens': cached_tokens}}
+        return LLMResult(generations=[[generation]], llm_output={'token_usage': token_usage,
+                                                                 'model_name': self.llm_name})
+
+
+class HashEmbeddings(PooledEmbeddings):
+    """
+    unit-length hashed bags of words: texts sharing words are close, identical texts get identical vectors,
+    so retrieval, similarity threshold and duplicate removal behave plausibly. Batching and concurrency are the
+    ones of the real embeddings
+    """
+
+    def __init__(self, api_pool, dim=cfg.fake_embedding_dim, latency=cfg.fake_embedding_latency, **kwargs):
+        super().__init__(api_pool, **kwargs)
+        self.dim = dim
+        self.latency = latency
+        # a model of its own for the embedding cache, fake vectors never mix with real ones
+        self.model = 'fake-hash-{}'.format(dim)
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in re.findall(r'\w+', text.lower()) or ['']:
+            digest = int.from_bytes(hashlib.md5(word.encode('utf-8')).digest()[:8], 'little')
+            vector[digest % self.dim] += 1. if digest >> 63 else -1.
+        norm = np.linalg.norm(vector)
+        if norm == 0:  # words cancelling out
+            vector[0], norm = 1., 1.
+        return (vector / norm).tolist()
+
+    def _request(self, texts, tokens):
+        self.api_pool.acquire_sync(tokens, kind='embedding')
+        self.api_pool.server.record_embeddings(len(texts))
+        time.sleep(self.latency)
+        return [self._embed(t) for t in texts]
+
+    def embed_query(self, text):
+        return self._request([text], count_tokens(text))[0]
+
+
+class FakeAPIPool(APIKeyPool):
+    """ APIKeyPool over fake keys: the client-side rate limiting is the real one, the models are fake """
+
+    def __init__(self, num_keys=cfg.fake_num_keys, server=None, **kwargs):
+        super().__init__(['fake-key-{}'.format(i) for i in range(num_keys)], **kwargs)
+        self.server = server if server is not None else FakeServer()
+
+    def get_llm(self, api_key, llm_name, max_tokens=512):
+        model_key = (api_key, llm_name, max_tokens)
+        if model_key not in self._models:
+            self._models[model_key] = FakeLLM(self.server, api_key, llm_name, max_tokens=max_tokens)
+        return self._models[model_key]
+
+    def embeddings(self):
+        return HashEmbeddings(self)
@@ -0,0 +1,304 @@
+"""
+ corpus-wide vector index: the chunk vectors of every processed report in one FAISS index, so that a question is
+ searched across all reports (or the reports of some companies / years) at once instead of one index per report.
+ Reports are appended as they are ingested: vectors.f32 holds the float32 rows of all reports, reports.jsonl one
+ line per report with its number of rows, company and year. Chunk texts and pages are read from the report's own
+ vector database when a chunk is returned
+"""
+import os
+import re
+import json
+import argparse
+import threading
+from collections import OrderedDict
+
+import faiss
+import numpy as np
+from langchain.docstore.document import Document
+
+import cfg
+from document import load_chunks, get_embeddings, TOP_K
+from embedding_cache import _file_lock
+from mapped_store import is_mapped, load_mapped_chunks
+from vector_index import build_index, search_parameters, load_vectors, stored_embedding_model, embedding_model_id
+
+VECTORS_FILE = 'vectors.f32'
+REPORTS_FILE = 'reports.jsonl'
+# reports whose chunk texts are kept in memory between searches
+MAX_CACHED_REPORTS = 64
+# candidates first searched per requested chunk when the chunks per report are capped, doubled until enough are left
+CANDIDATES_PER_RESULT = 10
+# index types that take appended rows as they are, indexes of the other types are trained on the rows of the reports
+# and built again when reports are added
+APPENDABLE_INDEX_TYPES = ('flat', 'hnsw')
+
+
+def report_year(report_name):
+    """ :return: year in a report name such as NYSE_SNE_2018, None if there is none """
+    years = re.findall(r'(?<!\d)(?:19|20)\d{2}(?!\d)', report_name)
+    return int(years[-1]) if years else None
+
+
+def _company_name(basic_info_path):
+    if basic_info_path and os.path.exists(basic_info_path):
+        with open(basic_info_path, 'r') as f:
+            return json.load(f).get('COMPANY_NAME') or None
+    return None
+
+
+def _as_set(values):
+    if values is None:
+        return None
+    if isinstance(values, (str, int)):
+        values = [values]
+    return set(values)
+
+
+class GlobalIndex:
+    def __init__(self, index_dir=cfg.global_index_dir, embeddings=None):
+        self.index_dir = index_dir
+        if not os.path.exists(index_dir):
+            os.makedirs(index_dir, exist_ok=True)
+        self.vectors_path = os.path.join(index_dir, VECTORS_FILE)
+        self.reports_path = os.path.join(index_dir, REPORTS_FILE)
+        self.meta_path = os.path.join(index_dir, 'meta.json')
+        self.lock_path = os.path.join(index_dir, '.lock')
+        # created on the first search, appending reports needs no embedding model
+        self.embeddings = embeddings
+        self.reports = []  # records of reports.jsonl, in row order
+        self.offsets = []  # first row of every report
+        self.num_rows = 0
+        self.dim = None
+        self.model = None  # embedding model of the reports, None if the first one did not record its model
+        self.index_type = cfg.faiss_index_type
+        self.index = None  # built on the first search
+        self._names = set()
+        self._db_paths = set()
+        self._reports_offset = 0
+        self._chunks = OrderedDict()  # db_path -> (chunks, page_idx)
+        self._lock = threading.Lock()
+        self._refresh()
+
+    def _refresh(self):
+        # pick up reports appended by other processes since the last look
+        if self.dim is None and os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as f:
+                meta = json.load(f)
+            self.dim = meta['dim']
+            self.model = meta.get('model')
+        if not os.path.exists(self.reports_path):
+            return
+        with open(self.reports_path, 'rb') as f:
+            f.seek(self._reports_offset)
+            data = f.read()
+        # only complete lines, another process may be writing the last one
+        data = data[:data.rfind(b'\n') + 1]
+        records = [json.loads(line) for line in data.decode('utf-8').splitlines()]
+        if records and self.index is not None:
+            if self.index_type in APPENDABLE_INDEX_TYPES:
+                num_new_rows = sum(r['rows'] for r in records)
+                vectors = np.fromfile(self.vectors_path, dtype=np.float32, count=num_new_rows * self.dim,
+                                      offset=self.num_rows * self.dim * 4)
+                self.index.add(vectors.reshape(num_new_rows, self.dim))
+            else:
+                self.index = None
+        for record in records:
+            self.reports.append(record)
+            self.offsets.append(self.num_rows)
+            self.num_rows += record['rows']
+            self._names.add(record['report'])
+            self._db_paths.add(record['db_path'])
+        self._reports_offset += len(data)
+
+    def _build_index(self):
+        vectors = np.fromfile(self.vectors_path, dtype=np.float32, count=self.num_rows * self.dim)
+        self.index = build_index(vectors.reshape(self.num_rows, self.dim), index_type=self.index_type)
+
+    def __len__(self):
+        return len(self.reports)
+
+    def __contains__(self, report_name):
+        return report_name in self._names
+
+    def add_report(self, report_name, db_path, company=None, year=None, basic_info_path=None):
+        """
+        append the chunk vectors of a report's vector database
+        :param company: company name, taken from the basic info of the report (or its name) if not given
+        :param year: report year, taken from the report name if not given
+        :return: False if the report (or another one with the same vector database) is in the index already
+        """
+        with self._lock, _file_lock(self.lock_path):
+            self._refresh()
+            if report_name in self._names or db_path in self._db_paths:
+                return False
+            vectors = np.ascontiguousarray(load_vectors(db_path), dtype=np.float32)
+            model = stored_embedding_model(db_path)
+            if self.dim is None:
+                with open(self.meta_path, 'w') as f:
+                    json.dump({'dim': vectors.shape[1], 'model': model}, f)
+                self._refresh()
+            assert vectors.shape[1] == self.dim, \
+                "{} has {}-dimensional vectors, the global index {}".format(db_path, vectors.shape[1], self.dim)
+            assert model is None or self.model is None or model == self.model, \
+                "{} was embedded with {}, the global index with {}".format(db_path, model, self.model)
+            record = {'report': report_name, 'db_path': db_path,
+                      'company': company or _company_name(basic_info_path) or report_name,
+                      'year': year if year is not None else report_year(report_name),
+                      'rows': len(vectors)}
+            with open(self.vectors_path, 'ab') as f:
+                # drop rows of a writer that died before registering its report
+                f.truncate(self.num_rows * self.dim * 4)
+                f.write(vectors.tobytes())
+                f.flush()
+            # the report is written last, its rows are never visible before its vectors
+            with open(self.reports_path, 'ab') as f:
+                f.write((json.dumps(record) + '\n').encode('utf-8'))
+            self._refresh()
+        return True
+
+    def _selector(self, reports=None, companies=None, years=None):
+        """ :return: faiss id selector of the rows of the matching reports, None if all reports match """
+        reports, years = _as_set(reports), _as_set(years)
+        companies = {c.lower() for c in _as_set(companies)} if companies is not None else None
+        ranges = []
+        for record, offset in zip(self.reports, self.offsets):
+            if reports is not None and record['report'] not in reports:
+                continue
+            if companies is not None and record['company'].lower() not in companies:
+                continue
+            if years is not None and record['year'] not in years:
+                continue
+            ranges.append((offset, offset + record['rows']))
+        if len(ranges) == len(self.reports):
+            return None
+        if len(ranges) == 1:
+            return faiss.IDSelectorRange(*ranges[0])
+        ids = np.concatenate([np.arange(start, end, dtype=np.int64) for start, end in ranges]) if ranges else \
+            np.zeros(0, dtype=np.int64)
+        return faiss.IDSelectorBatch(ids)
+
+    def _report_chunks(self, db_path):
+        if db_path in self._chunks:
+            self._chunks.move_to_end(db_path)
+        else:
+            # texts of a mapped vector database are decoded when accessed
+            self._chunks[db_path] = load_mapped_chunks(db_path) if is_mapped(db_path) else load_chunks(db_path)
+            while len(self._chunks) > MAX_CACHED_REPORTS:
+                self._chunks.popitem(last=False)
+        return self._chunks[db_path]
+
+    def _document(self, row):
+        report_no = int(np.searchsorted(self.offsets, row, side='right')) - 1
+        record = self.reports[report_no]
+        chunk_no = int(row - self.offsets[report_no])
+        chunks, page_idx = self._report_chunks(record['db_path'])
+        # pages of a mapped database are a numpy memmap, metadata is plain python for the JSON answers
+        return Document(page_content=chunks[chunk_no],
+                        metadata={'report': record['report'], 'company': record['company'], 'year': record['year'],
+                                  'page': int(page_idx[chunk_no]), 'source': str(chunk_no)})
+
+    def search(self, query, k=TOP_K, reports=None, companies=None, years=None, max_per_report=None):
+        """
+        :param reports, companies, years: only search the reports matching all given filters (value or list)
+        :param max_per_report: at most this many chunks of one report
+        :return: top-k (document, distance) pairs, the metadata of a document names its report, company, year and page
+        """
+        if self.embeddings is None:
+            self.embeddings = get_embeddings()
+        assert self.model is None or embedding_model_id(self.embeddings) == self.model, \
+            "the global index was embedded with {}, the current embedding model is {}".format(
+                self.model, embedding_model_id(self.embeddings))
+        query_vector = np.asarray([self.embeddings.embed_query(query)], dtype=np.float32)
+        with self._lock:
+            self._refresh()
+            if self.num_rows == 0:
+                return []
+            if self.index is None:
+                self._build_index()
+            selector = self._selector(reports=reports, companies=companies, years=years)
+            params = search_parameters(self.index, selector) if selector is not None else None
+            # rows of other reports are dropped here if the index cannot leave them out while searching
+            row_filter = selector if selector is not None and params is None else None
+            num_candidates = k * CANDIDATES_PER_RESULT if max_per_report or row_filter is not None else k
+            while True:
+                num_candidates = min(self.num_rows, num_candidates)
+                distances, rows = self.index.search(query_vector, num_candidates, params=params)
+                results = []
+                per_report = {}
+                dropped = 0
+                for distance, row in zip(distances[0], rows[0]):
+                    if row == -1:  # fewer matching chunks than candidates, or not found by an approximate index
+                        dropped += 1
+                        continue
+                    if row_filter is not None and not row_filter.is_member(int(row)):
+                        dropped += 1
+                        continue
+                    doc = self._document(int(row))
+                    if max_per_report:
+                        count = per_report.get(doc.metadata['report'], 0)
+                        if count >= max_per_report:
+                            dropped += 1
+                            continue
+                        per_report[doc.metadata['report']] = count + 1
+                    results.append((doc, float(distance)))
+                    if len(results) == k:
+                        break
+                # more candidates, until k are left or there are no more to search
+                if len(results) == k or dropped == 0 or num_candidates == self.num_rows:
+                    break
+                num_candidates *= 2
+        return results
+
+    def stats(self):
+        return {'reports': len(self.reports), 'chunks': self.num_rows, 'dim': self.dim,
+                'companies': len({r['company'] for r in self.reports})}
+
+
+def add_reports(global_index, vector_db_dir, basic_info_dir=None, llm_name='gpt-3.5-turbo'):
+    """ append every vector database of vector_db_dir not yet in the global index """
+    added = 0
+    for report_name in sorted(os.listdir(vector_db_dir)):
+        db_path = os.path.join(vector_db_dir, report_name)
+        if report_name in global_index or not (os.path.exists(os.path.join(db_path, 'index.faiss')) or
+                                               is_mapped(db_path)):
+            continue
+        basic_info_path = os.path.join(basic_info_dir, report_name + '_' + llm_name + '.json') \
+            if basic_info_dir else None
+        added += global_index.add_report(report_name, db_path, basic_info_path=basic_info_path)
+    return added
+
+
+def main():
+    from user_qa import UserQA
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index_dir", type=str, default=cfg.global_index_dir)
+    parser.add_argument("--add", action='store_true', default=False,
+                        help="append the vector databases of vector_db_dir that are not in the index yet")
+    parser.add_argument("--vector_db_dir", type=str, default='data/vector_db')
+    parser.add_argument("--basic_info_dir", type=str, default='data/basic_info')
+    parser.add_argument("--question", type=str, default='', help="question answered across the whole corpus")
+    parser.add_argument("--report", type=str, nargs='*', default=None)
+    parser.add_argument("--company", type=str, nargs='*', default=None)
+    parser.add_argument("--year", type=int, nargs='*', default=None)
+    parser.add_argument("--llm_name", type=str, default='gpt-3.5-turbo')
+    parser.add_argument("--answer_length", type=int, default=100)
+    parser.add_argument("--top_k", type=int, default=20)
+    parser.add_argument("--max_per_report", type=int, default=cfg.global_qa_max_per_report)
+    args = parser.parse_args()
+
+    global_index = GlobalIndex(args.index_dir)
+    if args.add:
+        added = add_reports(global_index, args.vector_db_dir, basic_info_dir=args.basic_info_dir,
+                            llm_name=args.llm_name)
+        print('added {} reports'.format(added))
+    print(global_index.stats())
+    if args.question:
+        answer, _ = UserQA(llm_name=args.llm_name).corpus_qa(
+            args.question, global_index, answer_length=args.answer_length, top_k=args.top_k,
+            reports=args.report, companies=args.company, years=args.year, max_per_report=args.max_per_report)
+        print(json.dumps(answer, indent=2))
+
+
+if __name__ == '__main__':
+    main()
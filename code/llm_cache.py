@@ -0,0 +1,107 @@
+"""
+ on-disk cache of LLM responses keyed on the prompt content, shared by all processes working on the same data dir
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+import cfg
+
+# the size is checked after this many insertions, eviction then removes the least recently used entries
+EVICTION_INTERVAL = 20
+# eviction frees space down to this fraction of the size limit
+EVICTION_TARGET = 0.9
+
+
+def make_key(llm_name, message, max_tokens):
+    """ hash of model, system prompt, rendered prompt and max_tokens """
+    if isinstance(message, str):
+        system_prompt, prompt = '', message
+    else:
+        system_prompt = '\n'.join(m.content for m in message[:-1])
+        prompt = message[-1].content
+    content = json.dumps([llm_name, system_prompt, prompt, max_tokens], ensure_ascii=False)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class LLMCache:
+    def __init__(self, path=cfg.llm_cache_path, max_bytes=cfg.llm_cache_max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._insertions = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connect(self):
+        # sqlite connections must not be shared with forked worker processes, each process opens its own
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            # write-ahead logging lets readers of other processes continue while one of them writes
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, '
+                               'size INTEGER, last_access REAL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)')
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key):
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute('SELECT response FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+            conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, response):
+        with self._lock:
+            conn = self._connect()
+            conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                         (key, response, len(response.encode('utf-8')), time.time()))
+            conn.commit()
+            self._insertions += 1
+            if self._insertions % EVICTION_INTERVAL == 0:
+                self._evict(conn)
+
+    def _evict(self, conn):
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        to_free = total - EVICTION_TARGET * self.max_bytes
+        freed = 0
+        keys = []
+        for key, size in conn.execute('SELECT key, size FROM responses ORDER BY last_access'):
+            keys.append((key,))
+            freed += size
+            if freed >= to_free:
+                break
+        conn.executemany('DELETE FROM responses WHERE key = ?', keys)
+        conn.commit()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+_llm_cache = None
+
+
+def get_llm_cache():
+    """ the process-wide cache, None when caching is switched off in cfg or the backend is fake """
+    global _llm_cache
+    # answers of the fake backend must never be served to real runs
+    if _llm_cache is None and cfg.use_llm_cache and cfg.llm_backend != 'fake':
+        _llm_cache = LLMCache()
+    return _llm_cache
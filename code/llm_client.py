@@ -0,0 +1,498 @@
+"""
+ OpenAI access shared by Report, Reader and UserQA: requests are spread over all keys of apikey.ini within their rate limits
+"""
+import os
+import re
+import time
+import asyncio
+import bisect
+import threading
+import configparser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+import tiktoken
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from langchain.llms import OpenAI
+from langchain.chat_models import ChatOpenAI
+from langchain.embeddings.base import Embeddings
+from langchain.embeddings.openai import OpenAIEmbeddings
+
+import cfg
+from llm_cache import get_llm_cache, make_key
+from tracing import get_tracer
+
+# upper bound of LLM requests in flight for one client (QA, assessment and basic info share it)
+MAX_CONCURRENCY = 16
+# length of the sliding window the rate limits refer to (seconds)
+RATE_WINDOW = 60.
+# number of texts sent in one embedding request
+EMBEDDING_BATCH_SIZE = 1000
+# transient errors, the request is sent again after a jittered exponential backoff
+RETRYABLE_ERRORS = (openai.error.RateLimitError, openai.error.APIError, openai.error.Timeout,
+                    openai.error.ServiceUnavailableError, openai.error.APIConnectionError, openai.error.TryAgain)
+RETRY_MULTIPLIER = 1
+RETRY_MAX_WAIT = 30
+# how long a key is benched after a 429 without rate-limit headers (seconds)
+RATE_LIMIT_PENALTY = 10.
+CONTEXT_LENGTH_ERROR = "maximum context length"
+
+_encoders = {}
+
+
+class ApproximateEncoder:
+    """ token counts without the tiktoken encoding files (offline backend only): about one token per 4 characters """
+
+    def encode(self, text, **kwargs):
+        return re.findall(r'\w{1,4}|[^\w\s]', text)
+
+
+def get_encoder(llm_name=None):
+    """ tiktoken encoding of the model (cl100k_base if none is given), loaded once per process """
+    if llm_name not in _encoders:
+        try:
+            _encoders[llm_name] = tiktoken.encoding_for_model(llm_name) if llm_name else \
+                tiktoken.get_encoding('cl100k_base')
+        except Exception as e:
+            # tiktoken downloads its encoding files on first use, which an air-gapped host cannot do
+            if cfg.llm_backend != 'fake':
+                raise
+            print('tiktoken encoding not available ({}), counting tokens approximately'.format(type(e).__name__))
+            _encoders[llm_name] = ApproximateEncoder()
+    return _encoders[llm_name]
+
+
+def count_tokens(text):
+    return len(get_encoder().encode(text))
+
+
+def message_tokens(message):
+    # message is either a completion prompt or a list of chat messages
+    if isinstance(message, str):
+        return count_tokens(message)
+    return sum(count_tokens(m.content) + 4 for m in message)
+
+
+def _parse_duration(value):
+    # header values look like '20', '0.5', '1s', '20ms' or '6m0s'
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {'h': 3600., 'm': 60., 's': 1., 'ms': 0.001}
+    parts = re.findall(r'([\d.]+)(ms|h|m|s)', value)
+    if not parts:
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def retry_after(error):
+    """ seconds the server asks us to wait before using the key again, None when it does not say """
+    headers = getattr(error, 'headers', None) or {}
+    delays = []
+    for name in ('retry-after', 'x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens'):
+        value = headers.get(name)
+        if value:
+            delay = _parse_duration(str(value))
+            if delay is not None:
+                delays.append(delay)
+    return max(delays) if delays else None
+
+
+def load_api_config(path='apikey.ini'):
+    config = configparser.ConfigParser()
+    config.read(path)
+    api_keys = config.get('OpenAI', 'OPENAI_API_KEYS')[1:-1].replace('\'', '').split(',')
+    api_keys = [k.strip() for k in api_keys if k.strip()]
+    # an alternative endpoint, e.g. a local fake server for testing
+    api_base = config.get('OpenAI', 'OPENAI_API_BASE', fallback=os.environ.get('OPENAI_API_BASE'))
+    return api_keys, api_base
+
+
+class KeyBudget:
+    """ requests and tokens consumed by one api key within the last RATE_WINDOW seconds """
+
+    def __init__(self, api_key, rpm_limit, tpm_limit):
+        self.api_key = api_key
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.window = deque()  # (timestamp, tokens) of scheduled requests, sorted by timestamp
+        self.window_tokens = 0
+        self.num_requests = 0
+        self.num_tokens = 0
+        self.blocked_until = 0.  # set when the server rejected the key for its rate limit
+
+    def _expire(self, now):
+        while self.window and self.window[0][0] <= now - RATE_WINDOW:
+            _, tokens = self.window.popleft()
+            self.window_tokens -= tokens
+
+    def wait_time(self, tokens, now):
+        """ seconds until a request of the given size fits into both budgets """
+        self._expire(now)
+        wait = 0.
+        if len(self.window) >= self.rpm_limit:
+            wait = self.window[len(self.window) - self.rpm_limit][0] + RATE_WINDOW - now
+        if self.window_tokens + tokens > self.tpm_limit:
+            # wait until enough of the oldest requests have left the window
+            freed = 0
+            for timestamp, used in self.window:
+                freed += used
+                if self.window_tokens - freed + tokens <= self.tpm_limit:
+                    wait = max(wait, timestamp + RATE_WINDOW - now)
+                    break
+        return max(wait, self.blocked_until - now, 0.)
+
+    def headroom(self):
+        return min(1 - len(self.window) / self.rpm_limit, 1 - self.window_tokens / self.tpm_limit)
+
+    def record(self, tokens, timestamp):
+        # a request booked to wait may be sent after requests booked later without waiting, _expire and the rpm
+        # check rely on the window staying in time order
+        bisect.insort(self.window, (timestamp, tokens))
+        self.window_tokens += tokens
+        self.num_requests += 1
+        self.num_tokens += tokens
+
+
+class APIKeyPool:
+    # kinds of requests, the api limits each model separately, so every kind has budgets of its own
+    KINDS = ('chat', 'embedding')
+
+    def __init__(self, api_keys, api_base=None, rpm_limit=cfg.api_rpm_limit, tpm_limit=cfg.api_tpm_limit,
+                 embedding_rpm_limit=cfg.api_embedding_rpm_limit, embedding_tpm_limit=cfg.api_embedding_tpm_limit):
+        """ :param rpm_limit, tpm_limit: limits of chat and completion requests, embedding_* those of embeddings """
+        assert len(api_keys) > 0, "no OpenAI api key configured"
+        self.api_keys = api_keys
+        self.api_base = api_base
+        self.kind_budgets = {'chat': [KeyBudget(k, rpm_limit, tpm_limit) for k in api_keys],
+                             'embedding': [KeyBudget(k, embedding_rpm_limit, embedding_tpm_limit) for k in api_keys]}
+        self.budgets = [b for kind in self.KINDS for b in self.kind_budgets[kind]]
+        # embeddings are requested from worker threads, chat completions from the event loop
+        self.lock = threading.Lock()
+        self._models = {}
+
+    def reserve(self, tokens, kind='chat'):
+        """
+        book a request on the key that can serve it first (ties go to the key with most headroom)
+        :param kind: 'chat' (chat and completion requests) or 'embedding'
+        :return: (api key, seconds to wait before sending the request)
+        """
+        with self.lock:
+            now = time.time()
+            best = min(self.kind_budgets[kind], key=lambda b: (b.wait_time(tokens, now), -b.headroom()))
+            wait = best.wait_time(tokens, now)
+            # the request is booked at its send time, so concurrent callers already see it
+            best.record(tokens, now + wait)
+            return best.api_key, wait
+
+    def block(self, api_key, seconds, kind='chat'):
+        """ keep a key out of rotation for a kind of requests after the server rejected it for its rate limit """
+        with self.lock:
+            for budget in self.kind_budgets[kind]:
+                if budget.api_key == api_key:
+                    budget.blocked_until = max(budget.blocked_until, time.time() + seconds)
+
+    async def acquire(self, tokens, kind='chat'):
+        api_key, wait = self.reserve(tokens, kind)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return api_key
+
+    def acquire_sync(self, tokens, kind='chat'):
+        api_key, wait = self.reserve(tokens, kind)
+        if wait > 0:
+            time.sleep(wait)
+        return api_key
+
+    def get_llm(self, api_key, llm_name, max_tokens=512):
+        model_key = (api_key, llm_name, max_tokens)
+        if model_key not in self._models:
+            if "turbo" in llm_name:
+                llm = ChatOpenAI(model_name=llm_name, temperature=0, max_tokens=max_tokens,
+                                 openai_api_key=api_key, openai_api_base=self.api_base, max_retries=1)
+            else:
+                llm = OpenAI(model_name=llm_name, temperature=0, max_tokens=max_tokens,
+                             openai_api_key=api_key, openai_api_base=self.api_base, max_retries=1)
+            self._models[model_key] = llm
+        return self._models[model_key]
+
+    def embeddings(self):
+        return PooledEmbeddings(self)
+
+    def stats(self):
+        return {kind: {b.api_key[-4:]: {'requests': b.num_requests, 'tokens': b.num_tokens} for b in budgets}
+                for kind, budgets in self.kind_budgets.items()}
+
+
+def token_batches(texts, max_texts=EMBEDDING_BATCH_SIZE, max_tokens=cfg.embedding_batch_tokens):
+    """
+    split texts into consecutive batches of at most max_texts texts and max_tokens tokens (a longer text is a batch
+    of its own)
+    :return: list of (texts, tokens) pairs
+    """
+    batches = []
+    batch, batch_tokens = [], 0
+    for text in texts:
+        tokens = count_tokens(text)
+        if batch and (len(batch) >= max_texts or batch_tokens + tokens > max_tokens):
+            batches.append((batch, batch_tokens))
+            batch, batch_tokens = [], 0
+        batch.append(text)
+        batch_tokens += tokens
+    if batch:
+        batches.append((batch, batch_tokens))
+    return batches
+
+
+class PooledEmbeddings(Embeddings):
+    """
+    OpenAI embeddings whose requests are spread over the keys of an APIKeyPool: texts are sent in token-bounded
+    batches, several batches at a time
+    """
+    model = 'text-embedding-ada-002'
+
+    def __init__(self, api_pool, batch_size=EMBEDDING_BATCH_SIZE, batch_tokens=cfg.embedding_batch_tokens,
+                 concurrency=cfg.embedding_concurrency):
+        """
+        :param batch_tokens: tokens per request, keeps requests under the per-request limit of the api
+        :param concurrency: requests in flight at a time
+        """
+        self.api_pool = api_pool
+        self.batch_size = batch_size
+        self.batch_tokens = batch_tokens
+        self.concurrency = concurrency
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+
+    def _client(self, api_key):
+        with self._clients_lock:
+            if api_key not in self._clients:
+                self._clients[api_key] = OpenAIEmbeddings(model=self.model, openai_api_key=api_key,
+                                                          openai_api_base=self.api_pool.api_base,
+                                                          chunk_size=self.batch_size)
+            return self._clients[api_key]
+
+    def _request(self, texts, tokens):
+        api_key = self.api_pool.acquire_sync(tokens, kind='embedding')
+        return self._client(api_key).embed_documents(texts)
+
+    def embed_documents(self, texts):
+        batches = token_batches(texts, self.batch_size, self.batch_tokens)
+        if len(batches) <= 1 or self.concurrency <= 1:
+            results = [self._request(batch, tokens) for batch, tokens in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(batches))) as executor:
+                results = list(executor.map(lambda b: self._request(*b), batches))
+        return [vector for vectors in results for vector in vectors]
+
+    def embed_query(self, text):
+        api_key = self.api_pool.acquire_sync(count_tokens(text), kind='embedding')
+        return self._client(api_key).embed_query(text)
+
+
+class BatchEmbedder:
+    """
+    embeds texts as they are produced: every full batch is sent from a thread pool right away, so that the producer
+    (e.g. the extraction of later pages) goes on while earlier batches are embedded. Used as a context manager, the
+    thread pool is shut down also when the producer fails before result()
+    """
+
+    def __init__(self, embeddings, max_texts=EMBEDDING_BATCH_SIZE, max_tokens=cfg.embedding_batch_tokens,
+                 concurrency=None):
+        """ :param concurrency: batches in flight at a time, by default the one of the embeddings (1 if they have none) """
+        self.embeddings = embeddings
+        self.max_texts = max_texts
+        self.max_tokens = max_tokens
+        concurrency = concurrency or getattr(embeddings, 'concurrency', 1)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+        self.futures = []  # in the order of the texts
+        self._batch, self._batch_tokens = [], 0
+
+    def add(self, texts):
+        for text in texts:
+            tokens = count_tokens(text)
+            if self._batch and (len(self._batch) >= self.max_texts or self._batch_tokens + tokens > self.max_tokens):
+                self._submit()
+            self._batch.append(text)
+            self._batch_tokens += tokens
+
+    def _submit(self):
+        self.futures.append(self.executor.submit(self.embeddings.embed_documents, self._batch))
+        self._batch, self._batch_tokens = [], 0
+
+    def result(self):
+        """ :return: vectors of all texts added, in order """
+        if self._batch:
+            self._submit()
+        try:
+            return [vector for future in self.futures for vector in future.result()]
+        finally:
+            self.close()
+
+    def close(self):
+        """ batches not started yet are cancelled """
+        self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+_api_pool = None
+
+
+def get_api_pool():
+    """ the process-wide pool built from apikey.ini, or the offline stand-in if cfg.llm_backend is 'fake' """
+    global _api_pool
+    if _api_pool is None and cfg.llm_backend == 'fake':
+        from fake_backend import FakeAPIPool  # imports this module
+        _api_pool = FakeAPIPool()
+    if _api_pool is None:
+        api_keys, api_base = load_api_config()
+        # code that still creates its own OpenAI clients picks up the first key
+        os.environ["OPENAI_API_KEY"] = api_keys[0]
+        _api_pool = APIKeyPool(api_keys, api_base=api_base)
+    return _api_pool
+
+
+def set_api_pool(api_pool):
+    """ point every client created afterwards (Report, Reader, UserQA) at another pool, e.g. a FakeAPIPool """
+    global _api_pool
+    _api_pool = api_pool
+
+
+class TokenUsage:
+    """ input tokens reported by the server, split into the part served from its prompt-prefix cache and the rest """
+
+    def __init__(self):
+        self.num_requests = 0
+        self.input_tokens = 0
+        self.cached_input_tokens = 0
+        self.output_tokens = 0
+        self.lock = threading.Lock()
+
+    def record(self, token_usage):
+        # older endpoints do not report prompt_tokens_details, nothing counts as cached then
+        details = token_usage.get('prompt_tokens_details') or {}
+        with self.lock:
+            self.num_requests += 1
+            self.input_tokens += token_usage.get('prompt_tokens', 0)
+            self.cached_input_tokens += details.get('cached_tokens', 0)
+            self.output_tokens += token_usage.get('completion_tokens', 0)
+
+    def stats(self):
+        return {'requests': self.num_requests, 'input_tokens': self.input_tokens,
+                'cached_input_tokens': self.cached_input_tokens,
+                'uncached_input_tokens': self.input_tokens - self.cached_input_tokens,
+                'output_tokens': self.output_tokens}
+
+
+_token_usage = None
+
+
+def get_token_usage():
+    """ the process-wide token usage of all LLM clients """
+    global _token_usage
+    if _token_usage is None:
+        _token_usage = TokenUsage()
+    return _token_usage
+
+
+class LLMClient:
+    """ sends chat or completion prompts of one model through the key pool, with a bounded number in flight """
+
+    def __init__(self, llm_name, api_pool=None, max_concurrency=MAX_CONCURRENCY, cache=None):
+        self.llm_name = llm_name
+        self.api_pool = api_pool if api_pool is not None else get_api_pool()
+        self.cache = cache if cache is not None else get_llm_cache()
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+        self._semaphore_loop = None
+        self.num_retries = 0
+        self.usage = get_token_usage()
+
+    def _get_semaphore(self):
+        # asyncio.run creates a new event loop every time, the semaphore has to belong to the running one
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
+    async def _send(self, message, max_tokens, span=None):
+        # retries are done here rather than inside langchain, so that every attempt can pick another key
+        async for attempt in AsyncRetrying(retry=retry_if_exception_type(RETRYABLE_ERRORS),
+                                           wait=wait_random_exponential(multiplier=RETRY_MULTIPLIER,
+                                                                        max=RETRY_MAX_WAIT),
+                                           stop=stop_after_attempt(cfg.llm_max_retries), reraise=True):
+            with attempt:
+                if attempt.retry_state.attempt_number > 1:
+                    self.num_retries += 1
+                    if span is not None:
+                        span.add(retries=1)
+                # max_tokens counts towards the token budget of the key as well
+                api_key = await self.api_pool.acquire(message_tokens(message) + max_tokens)
+                llm = self.api_pool.get_llm(api_key, self.llm_name, max_tokens=max_tokens)
+                try:
+                    result = await llm.agenerate([message])
+                except openai.error.RateLimitError as e:
+                    delay = retry_after(e)
+                    self.api_pool.block(api_key, delay if delay is not None else RATE_LIMIT_PENALTY)
+                    raise
+        token_usage = (result.llm_output or {}).get('token_usage', {})
+        self.usage.record(token_usage)
+        if span is not None:
+            span.add(tokens_in=token_usage.get('prompt_tokens', 0), tokens_out=token_usage.get('completion_tokens', 0),
+                     cached_tokens=(token_usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0))
+        return result.generations[0][0].text
+
+    async def generate_one(self, message, max_tokens=512, shrink=None, key=None):
+        """
+        :param shrink: optional function returning a smaller version of the message (or None), used when the
+                       prompt does not fit into the context window of the model
+        :param key: what the request is for (e.g. the question key), recorded with its span
+        """
+        with get_tracer().span('llm_request', model=self.llm_name, key=key) as span:
+            if self.cache is not None:
+                cache_key = make_key(self.llm_name, message, max_tokens)
+                output_text = self.cache.get(cache_key)
+                if output_text is not None:
+                    span.set(cache_hits=1)
+                    return output_text
+            span.set(cache_hits=0)
+            async with self._get_semaphore():
+                while True:
+                    try:
+                        output_text = await self._send(message, max_tokens, span=span)
+                        break
+                    except openai.error.InvalidRequestError as e:
+                        if shrink is None or CONTEXT_LENGTH_ERROR not in str(e):
+                            raise
+                        message = shrink()
+                        if message is None:
+                            raise
+                        span.add(shrunk=1)
+                        print('prompt exceeds the context window, retrying it with fewer chunks')
+            if self.cache is not None:
+                # stored under the prompt the caller asked for, even if a shorter one had to be sent
+                self.cache.put(cache_key, output_text)
+            return output_text
+
+    async def agenerate(self, messages, max_tokens=512, shrinkers=None, keys=None):
+        """
+        one request per message, the outputs are returned in the order of the messages;
+        a failing request is retried on its own, the others are not affected. A request still failing after its
+        retries does not abort the others, its output is the exception it raised
+        :param keys: what every request is for, recorded with its span
+        """
+        if shrinkers is None:
+            shrinkers = [None] * len(messages)
+        if keys is None:
+            keys = [None] * len(messages)
+        return await asyncio.gather(*[self.generate_one(message, max_tokens=max_tokens, shrink=shrink, key=key)
+                                      for message, shrink, key in zip(messages, shrinkers, keys)],
+                                    return_exceptions=True)
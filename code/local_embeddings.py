@@ -0,0 +1,73 @@
+"""
+ local embedding model (cfg.embedding_backend = 'local'): a sentence-transformers model embeds the chunks on the CPU,
+ batch by batch with multi-threaded inference, so that ingesting a report sends no embedding requests at all.
+ sentence-transformers is an optional dependency, it is only imported when the local backend is used
+"""
+import os
+import threading
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+import cfg
+
+# model ids of local models carry this prefix, they are never taken for an api model of the same name
+MODEL_ID_PREFIX = 'local/'
+
+
+class LocalEmbeddings(Embeddings):
+    # batches are encoded one at a time (see below), parallelism is within a forward pass
+    concurrency = 1
+
+    def __init__(self, model_name=cfg.local_embedding_model, batch_size=cfg.local_embedding_batch_size,
+                 num_threads=cfg.local_embedding_threads, device='cpu'):
+        """
+        :param model_name: sentence-transformers model name or path
+        :param batch_size: texts per forward pass
+        :param num_threads: torch threads of the forward passes, 0 for one per core
+        """
+        try:
+            import torch
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ImportError("embedding_backend = 'local' needs sentence-transformers "
+                              "(pip install sentence-transformers)") from e
+        # the threads of one forward pass; batches are run one after the other, a tokenizer shared by several
+        # threads is not safe
+        torch.set_num_threads(num_threads or os.cpu_count() or 1)
+        self.encoder = SentenceTransformer(model_name, device=device)
+        self.batch_size = batch_size
+        self.dim = self.encoder.get_sentence_embedding_dimension()
+        # recorded with the vector databases and keys the embedding cache
+        self.model = MODEL_ID_PREFIX + model_name
+        # the model is shared by every report of the process, and ingest threads and queries call it concurrently
+        self._encode_lock = threading.Lock()
+
+    def _encode(self, texts):
+        # unit length like the OpenAI embeddings, the similarity of the retrieval filter relies on it
+        with self._encode_lock:
+            vectors = self.encoder.encode(list(texts), batch_size=self.batch_size, normalize_embeddings=True,
+                                          convert_to_numpy=True, show_progress_bar=False)
+        return np.asarray(vectors, dtype=np.float32)
+
+    def embed_documents(self, texts):
+        if len(texts) == 0:
+            return []
+        return self._encode(texts).tolist()
+
+    def embed_query(self, text):
+        return self._encode([text])[0].tolist()
+
+
+_local_embeddings = None
+_local_embeddings_lock = threading.Lock()
+
+
+def get_local_embeddings():
+    """ the process-wide local model, loaded once """
+    global _local_embeddings
+    if _local_embeddings is None:
+        with _local_embeddings_lock:
+            if _local_embeddings is None:
+                _local_embeddings = LocalEmbeddings()
+    return _local_embeddings
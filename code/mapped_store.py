@@ -0,0 +1,220 @@
+"""
+ vector database whose vectors (float16 or float32 rows) and chunk texts (one utf-8 blob indexed by byte offsets)
+ are memory-mapped from db_path instead of unpickled into memory, so that many reports can be open at once with only
+ the pages touched by searches resident. Search is exact (L2 over all rows, block by block).
+ Run as a script to compare load time and memory of the mapped and the faiss / pickle stores
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.vectorstores.base import VectorStore
+
+import cfg
+from memory_usage import rss_bytes
+
+MAPPED_META_FILE = 'mapped.json'
+TEXTS_FILE = 'texts.bin'
+TEXT_OFFSETS_FILE = 'text_offsets.i64'
+PAGES_FILE = 'pages.i32'
+VECTOR_FILES = {'float16': 'vectors.f16', 'float32': 'vectors.f32'}
+# rows converted to float32 at a time by a search
+SEARCH_BLOCK_ROWS = 16384
+
+
+def is_mapped(db_path):
+    # the meta file is written last, a partly written store is not mapped
+    return os.path.exists(os.path.join(db_path, MAPPED_META_FILE))
+
+
+def _memmap(path, dtype, shape=None):
+    if os.path.getsize(path) == 0:  # mmap cannot map an empty file
+        return np.zeros(shape or 0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+
+
+class MappedTexts:
+    """ read-only sequence of texts, decoded from the blob when accessed """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets  # len(texts) + 1 byte offsets into the blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def _open(db_path):
+    """ :return: vectors, texts and pages of a mapped vector database """
+    with open(os.path.join(db_path, MAPPED_META_FILE), 'r') as f:
+        meta = json.load(f)
+    vectors = _memmap(os.path.join(db_path, VECTOR_FILES[meta['dtype']]), meta['dtype'],
+                      shape=(meta['count'], meta['dim']))
+    texts = MappedTexts(_memmap(os.path.join(db_path, TEXTS_FILE), np.uint8),
+                        _memmap(os.path.join(db_path, TEXT_OFFSETS_FILE), np.int64))
+    pages = _memmap(os.path.join(db_path, PAGES_FILE), np.int32, shape=(meta['count'],))
+    return vectors, texts, pages
+
+
+def load_mapped_vectors(db_path):
+    return _open(db_path)[0]
+
+
+def load_mapped_chunks(db_path):
+    """ :return: chunk texts and their pages of a mapped vector database """
+    _, texts, pages = _open(db_path)
+    return texts, pages
+
+
+class MappedVectorStore(VectorStore):
+    """
+    vectors, texts and pages of the chunks of one report, row i is chunk i. Documents carry the same metadata as in
+    the faiss store ("source": chunk number, "page")
+    """
+
+    def __init__(self, embedding_function, vectors, texts, pages):
+        self.embedding_function = embedding_function
+        self.vectors = vectors
+        self.texts = texts
+        self.pages = pages
+
+    @classmethod
+    def load(cls, db_path, embeddings):
+        return cls(embeddings.embed_query, *_open(db_path))
+
+    def save_local(self, db_path, dtype=None):
+        """ write the mapped files, the store then reads its vectors and texts from them """
+        dtype = dtype or cfg.mapped_vector_dtype
+        if not os.path.exists(db_path):
+            os.makedirs(db_path, exist_ok=True)
+        encoded = [text.encode('utf-8') for text in self.texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(t) for t in encoded])
+        np.asarray(self.vectors, dtype=dtype).tofile(os.path.join(db_path, VECTOR_FILES[dtype]))
+        with open(os.path.join(db_path, TEXTS_FILE), 'wb') as f:
+            f.write(b''.join(encoded))
+        offsets.tofile(os.path.join(db_path, TEXT_OFFSETS_FILE))
+        np.asarray(self.pages, dtype=np.int32).tofile(os.path.join(db_path, PAGES_FILE))
+        with open(os.path.join(db_path, MAPPED_META_FILE), 'w') as f:
+            json.dump({'count': len(encoded), 'dim': int(np.shape(self.vectors)[1]), 'dtype': dtype}, f)
+        self.vectors, self.texts, self.pages = _open(db_path)
+
+    def _document(self, i):
+        return Document(page_content=self.texts[i], metadata={"source": str(i), "page": str(int(self.pages[i]))})
+
+    def search_vectors(self, query_vectors, k):
+        """
+        :param query_vectors: float32 matrix, one row per query
+        :return: list with the top-k (document, squared L2 distance) pairs of every query
+        """
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+        num_queries, num_rows = len(query_vectors), len(self.vectors)
+        k = min(k, num_rows)
+        query_norms = (query_vectors ** 2).sum(axis=1)[:, None]
+        distances = np.zeros((num_queries, 0), dtype=np.float32)
+        rows = np.zeros((num_queries, 0), dtype=np.int64)
+        for start in range(0, num_rows, SEARCH_BLOCK_ROWS):
+            block = np.asarray(self.vectors[start:start + SEARCH_BLOCK_ROWS], dtype=np.float32)
+            block_distances = (block ** 2).sum(axis=1)[None, :] - 2 * query_vectors @ block.T + query_norms
+            distances = np.concatenate([distances, block_distances], axis=1)
+            rows = np.concatenate([rows, np.tile(np.arange(start, start + len(block)), (num_queries, 1))], axis=1)
+            if distances.shape[1] > k:  # keep the k best so far
+                best = np.argpartition(distances, k - 1, axis=1)[:, :k]
+                distances = np.take_along_axis(distances, best, axis=1)
+                rows = np.take_along_axis(rows, best, axis=1)
+        order = np.argsort(distances, axis=1)
+        distances = np.take_along_axis(distances, order, axis=1)
+        rows = np.take_along_axis(rows, order, axis=1)
+        return [[(self._document(int(i)), max(float(d), 0.)) for d, i in zip(row_distances, row_rows)]
+                for row_distances, row_rows in zip(distances, rows)]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.search_vectors([self.embedding_function(query)], k)[0]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k)]
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError("a mapped vector database is written once, rebuild it to add chunks")
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, vectors=None, **kwargs):
+        """ :param vectors: embeddings of the texts if they are embedded already """
+        if vectors is None:
+            vectors = embedding.embed_documents(texts)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        pages = [int(m['page']) for m in metadatas] if metadatas else [0] * len(texts)
+        return cls(embedding.embed_query, vectors, list(texts), pages)
+
+
+def measure(storage, db_paths, queries_per_report=1):
+    """ load time and resident memory of opening all db_paths with the given storage, before and after searching """
+    from langchain.embeddings import FakeEmbeddings  # searches use random vectors, nothing is embedded
+    from vector_index import load_vector_store
+
+    cfg.vector_storage = storage
+    rss_before = rss_bytes()
+    start_time = time.time()
+    stores = []
+    for db_path in db_paths:
+        with open(os.path.join(db_path, MAPPED_META_FILE), 'r') as f:
+            dim = json.load(f)['dim']
+        stores.append(load_vector_store(db_path, FakeEmbeddings(size=dim), check_model=False))
+    load_time = time.time() - start_time
+    rss_loaded = rss_bytes()
+    rng = np.random.default_rng(0)
+    start_time = time.time()
+    for store in stores:
+        dim = store.index.d if storage == 'faiss' else store.vectors.shape[1]
+        query_vectors = rng.standard_normal((queries_per_report, dim)).astype(np.float32)
+        if storage == 'faiss':
+            store.index.search(query_vectors, cfg.retriever_top_k)
+        else:
+            store.search_vectors(query_vectors, cfg.retriever_top_k)
+    search_time = time.time() - start_time
+    return {'reports': len(stores), 'load_seconds': round(load_time, 3), 'search_seconds': round(search_time, 3),
+            'rss_loaded_mb': round((rss_loaded - rss_before) / 2 ** 20, 1),
+            'rss_searched_mb': round((rss_bytes() - rss_before) / 2 ** 20, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_paths", type=str, nargs='+', required=True)
+    parser.add_argument("--dtype", type=str, default=cfg.mapped_vector_dtype, choices=sorted(VECTOR_FILES))
+    parser.add_argument("--measure", type=str, default='', choices=['', 'faiss', 'mmap'],
+                        help="measure one storage in this process (used by the comparison)")
+    args = parser.parse_args()
+
+    # databases built with vector_storage = 'mmap' have no faiss files to compare with
+    db_paths = [p for p in args.db_paths if os.path.exists(os.path.join(p, 'index.faiss'))]
+    if args.measure:
+        print(json.dumps(measure(args.measure, db_paths)))
+        return
+    from langchain.embeddings import FakeEmbeddings
+    from vector_index import convert_to_mapped
+    cfg.mapped_vector_dtype = args.dtype
+    for db_path in db_paths:
+        if not is_mapped(db_path):
+            convert_to_mapped(db_path, FakeEmbeddings(size=1))  # only the stored vectors are converted
+    # every storage is measured in a fresh process, so that neither sees the memory of the other
+    results = {}
+    for storage in ('faiss', 'mmap'):
+        output = subprocess.run([sys.executable, __file__, '--measure', storage, '--db_paths'] + db_paths,
+                                check=True, capture_output=True, text=True).stdout
+        results[storage] = json.loads(output.strip().splitlines()[-1])
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
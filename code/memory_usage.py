@@ -0,0 +1,19 @@
+"""
+ resident memory of the current process, for the measurements of benchmark.py and mapped_store.py
+"""
+import os
+
+
+def rss_bytes():
+    """ current resident set size (the peak on systems without /proc) """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    """ largest resident set size of the process so far """
+    import resource  # unix only, imported when needed
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,248 @@
+"""
+ resident user QA service: parsed reports (vector index, chunks, basic info) stay in memory between questions,
+ so answering a question only costs the retrieval and one LLM request.
+ Requests are JSON objects {"pdf_path" or "pdf_url", "question", optional "answer_length" and "top_k"},
+ either POSTed to http://host:port/qa or written to stdin one per line (--stdin)
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import cfg
+from corpus import build_report, get_report_name
+from user_qa import UserQA
+from tracing import get_tracer, PrometheusExporter
+
+# number of reports kept in memory, the least recently asked one is dropped first
+MAX_REPORTS = 8
+
+
+class ReportCache:
+    """ LRU map from report name to parsed report, a report requested by several threads at once is built once """
+
+    def __init__(self, args, capacity=MAX_REPORTS, pdf_store_dir='data/pdf/'):
+        self.args = args
+        self.capacity = capacity
+        self.pdf_store_dir = pdf_store_dir
+        self.reports = OrderedDict()
+        self.lock = threading.Lock()
+        self._build_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, source):
+        report_name = get_report_name(source)
+        with self.lock:
+            if report_name in self.reports:
+                self.reports.move_to_end(report_name)
+                self.hits += 1
+                return self.reports[report_name]
+            build_lock = self._build_locks.setdefault(report_name, threading.Lock())
+        with build_lock:
+            with self.lock:
+                # built by another thread while this one was waiting
+                if report_name in self.reports:
+                    self.reports.move_to_end(report_name)
+                    self.hits += 1
+                    return self.reports[report_name]
+            report = None
+            try:
+                # lazy: a report whose vector database exists is served without opening its pdf
+                report = build_report(self.args, source, pdf_store_dir=self.pdf_store_dir, lazy=True)
+            finally:
+                with self.lock:
+                    # dropped also when the build failed, so the next request retries with a fresh lock
+                    self._build_locks.pop(report_name, None)
+                    if report is not None:
+                        self.misses += 1
+                        self.reports[report_name] = report
+                        while len(self.reports) > self.capacity:
+                            evicted_name, _ = self.reports.popitem(last=False)
+                            self.evictions += 1
+                            print('[qa_server] evicted', evicted_name)
+            return report
+
+    def stats(self):
+        with self.lock:
+            return {'reports': list(self.reports.keys()), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+class RequestError(ValueError):
+    """ a request the client has to fix, answered with 400 """
+
+
+def validate_request(request):
+    """ raise RequestError unless the request names a report, asks a question and has sensible options """
+    if not isinstance(request, dict):
+        raise RequestError('request must be a JSON object')
+    source = request.get('pdf_path') or request.get('pdf_url')
+    if not isinstance(source, str) or not source:
+        raise RequestError('pdf_path or pdf_url is required')
+    try:
+        get_report_name(source)
+    except ValueError as e:
+        raise RequestError(str(e)) from None
+    question = request.get('question')
+    if not isinstance(question, str) or not question.strip():
+        raise RequestError('question is required')
+    for name in ('answer_length', 'top_k'):
+        value = request.get(name)
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value <= 0):
+            raise RequestError('{} must be a positive integer'.format(name))
+
+
+class QAServer:
+    def __init__(self, args, max_reports=MAX_REPORTS):
+        self.args = args
+        self.reports = ReportCache(args, capacity=max_reports)
+        self.user_qa = UserQA(llm_name=args.llm_name, keep_history=False)
+        # every question runs on one event loop, so the LLM client keeps a single semaphore and connection pool
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.file_lock = threading.Lock()
+
+    def answer(self, request):
+        start_time = time.time()
+        validate_request(request)
+        source = request.get('pdf_path') or request.get('pdf_url')
+        report_name = get_report_name(source)
+        report = self.reports.get(source)
+        load_time = time.time() - start_time
+        basic_info_path = os.path.join(self.args.basic_info_dir, report_name + '_' + self.args.llm_name + '.json')
+        future = asyncio.run_coroutine_threadsafe(
+            self.user_qa.auser_qa(request['question'], report, basic_info_path=basic_info_path,
+                                  answer_length=request.get('answer_length', self.args.answer_length),
+                                  top_k=request.get('top_k', self.args.top_k)),
+            self.loop)
+        answer, _ = future.result()
+        with self.file_lock:
+            with open(os.path.join(self.args.user_qa_dir, report_name + '_' + self.args.llm_name + '.jsonl'),
+                      'a') as f:
+                f.write(json.dumps(answer) + '\n')
+        return {'report': report_name, 'answer': answer, 'load_seconds': round(load_time, 3),
+                'seconds': round(time.time() - start_time, 3)}
+
+    def handle(self, request):
+        """ :return: (HTTP status, response) """
+        try:
+            return 200, self.answer(request)
+        except RequestError as e:
+            return 400, {'error': str(e)}
+        except Exception as e:
+            return 500, {'error': '{}: {}'.format(type(e).__name__, e)}
+
+    def serve_stdin(self):
+        # progress messages of parsing and answering go to stderr, stdout only carries the responses
+        out, sys.stdout = sys.stdout, sys.stderr
+        for line in sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = {'error': 'invalid JSON: {}'.format(e)}
+            else:
+                _, response = self.handle(request)
+            out.write(json.dumps(response) + '\n')
+            out.flush()
+
+    def serve_http(self, host, port):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path == '/stats':
+                    self._reply(200, server.reports.stats())
+                elif self.path == '/metrics':
+                    exporter = get_tracer().exporter(PrometheusExporter)
+                    if exporter is None:
+                        self._reply(404, {'error': "tracing exporter 'prometheus' is not configured"})
+                        return
+                    data = exporter.render().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                else:
+                    self._reply(404, {'error': 'not found'})
+
+            def do_POST(self):
+                if self.path != '/qa':
+                    self._reply(404, {'error': 'not found'})
+                    return
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                except ValueError as e:
+                    self._reply(400, {'error': 'invalid JSON: {}'.format(e)})
+                    return
+                self._reply(*server.handle(request))
+
+        httpd = ThreadingHTTPServer((host, port), Handler)
+        print('[qa_server] listening on http://{}:{}'.format(host, port))
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--stdin", action='store_true', default=False,
+                        help="read JSON-lines requests from stdin and write the responses to stdout")
+    parser.add_argument("--max_reports", type=int, default=MAX_REPORTS,
+                        help="number of reports kept in memory")
+    parser.add_argument("--llm_name", type=str, default='gpt-3.5-turbo')
+    parser.add_argument("--basic_info_dir", type=str, default='data/basic_info')
+    parser.add_argument("--vector_db_dir", type=str, default='data/vector_db')
+    parser.add_argument("--retrieved_chunks_dir", type=str, default='data/retrieved_chunks')
+    parser.add_argument("--user_qa_dir", type=str, default='data/user_qa')
+    parser.add_argument("--answer_length", type=int, default=50)
+    parser.add_argument("--top_k", type=int, default=20)
+    parser.add_argument("--extract_workers", type=int, default=1,
+                        help="number of processes used to extract PDF pages")
+    parser.add_argument("--llm_backend", type=str, default=cfg.llm_backend, choices=['openai', 'fake'],
+                        help="'fake' runs offline with canned answers and hashed embeddings (see fake_backend.py)")
+    parser.add_argument("--tracing_exporters", type=str, nargs='*', default=cfg.tracing_exporters,
+                        choices=['jsonl', 'prometheus'], help="where spans of stages and LLM requests go (tracing.py)")
+    parser.add_argument("--embedding_backend", type=str, default=cfg.embedding_backend, choices=['api', 'local'],
+                        help="'local' embeds with the sentence-transformers model of cfg.py on the CPU")
+    args = parser.parse_args()
+    cfg.llm_backend = args.llm_backend
+    cfg.embedding_backend = args.embedding_backend
+    cfg.tracing_exporters = args.tracing_exporters
+
+    for directory in [args.basic_info_dir, args.vector_db_dir, args.retrieved_chunks_dir, args.user_qa_dir,
+                      'data/pdf/']:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    server = QAServer(args, max_reports=args.max_reports)
+    if args.stdin:
+        server.serve_stdin()
+    else:
+        server.serve_http(args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,9 @@
 import os
 import re
+import asyncio
 import tenacity
-import configparser
 import markdown
 
-from langchain.llms import OpenAI
-from langchain.chat_models import ChatOpenAI
 from langchain.schema import (
     AIMessage,
     HumanMessage,
@@ -14,16 +12,16 @@ from langchain.schema import (
 from langchain.prompts import PromptTemplate
 import cfg
 import json
-import tiktoken
+from llm_client import LLMClient, MAX_CONCURRENCY, get_encoder
+from context_packer import ContextPacker
+from tracing import get_tracer, set_trace_context
 # main class for reading the pdf and communicate with openai
 
 
-config = configparser.ConfigParser()
-config.read('apikey.ini')
-chat_api_list = config.get('OpenAI', 'OPENAI_API_KEYS')[1:-1].replace('\'', '').split(',')
-os.environ["OPENAI_API_KEY"] = chat_api_list[0]
 
 TOP_K = 20
+# chunks dropped from a prompt each time the model rejects it for exceeding its context window
+CONTEXT_FALLBACK_STEP = 5
 PROMPTS = {
     'general':
         """You are tasked with the role of a climate scientist, assigned to analyze a company's sustainability report. Based on the following extracted parts from the sustainability report, answer the given QUESTIONS. 
@@ -40,18 +38,14 @@ QUESTIONS:
 =========
 Your FINAL_ANSWER in JSON (ensure there's no format error):
 """,
-    'tcfd_qa_source': """As a senior equity analyst with expertise in climate science evaluating a company's sustainability report, you are presented with the following background information:
-
-{basic_info}
-
-With the above information and the following extracted components (which may have incomplete sentences at the beginnings and the ends) of the sustainability report at hand, please respond to the posed question, ensuring to reference the relevant parts ("SOURCES").
-Format your answer in JSON format with the two keys: ANSWER (this should contain your answer string without sources), and SOURCES (this should be a list of the source numbers that were referenced in your answer).
-
-QUESTION: {question}
+    'tcfd_qa_source': """The following extracted components (which may have incomplete sentences at the beginnings and the ends) of a company's sustainability report, each with its source number, are the report context of this task:
 =========
 {summaries}
 =========
 
+As a senior equity analyst with expertise in climate science evaluating the company's sustainability report, you are asked to respond to a question about the report based on the above extracts, ensuring to reference the relevant parts ("SOURCES").
+Format your answer in JSON format with the two keys: ANSWER (this should contain your answer string without sources), and SOURCES (this should be a list of the source numbers that were referenced in your answer).
+
 Please adhere to the following guidelines in your answer:
 1. Your response must be precise, thorough, and grounded on specific extracts from the report to verify its authenticity.
 2. If you are unsure, simply acknowledge the lack of knowledge, rather than fabricating an answer.
@@ -60,8 +54,15 @@ Please adhere to the following guidelines in your answer:
 5. cheap talks are statements that are costless to make and may not necessarily reflect the true intentions or future actions of the company. Be critical for all cheap talks you discovered in the report.
 6. Always acknowledge that the information provided is representing the company's view based on its report.
 7. Scrutinize whether the report is grounded in quantifiable, concrete data or vague, unverifiable statements, and communicate your findings.
-{guidelines}
 
+You are presented with the following background information:
+
+{basic_info}
+
+With the above information and the extracted components of the sustainability report at hand, please respond to the posed question.
+
+QUESTION: {question}
+{guidelines}
 Your FINAL_ANSWER in JSON (ensure there's no format error):
 """,
     'user_qa_source': """As a senior equity analyst with expertise in climate science evaluating a company's sustainability report, you are presented with the following background information:
@@ -129,29 +130,25 @@ QUESTION: {question}
 {summaries}
 =========
 """,
-    'tcfd_assessment': """Your task is to rate a sustainability report's disclosure quality on the following <CRITICAL_ELEMENT>:
+    'tcfd_assessment': """The following extracted components (which may have incomplete sentences at the beginnings and the ends) of a company's sustainability report, each with its source number, are the report context of this task:
+=========
+{disclosure}
+=========
 
-<CRITICAL_ELEMENT>: {question}
+Your task is to rate the sustainability report's disclosure quality on a <CRITICAL_ELEMENT>, given the <REQUIREMENTS> that outline the necessary components for high-quality disclosure pertaining to the <CRITICAL_ELEMENT>.
+The above extracts, which pertain to the <CRITICAL_ELEMENT>, are the <DISCLOSURE> (their source numbers can be ignored).
+Please analyze the extent to which the given <DISCLOSURE> satisfies the <REQUIREMENTS>. Your ANALYSIS should specify which <REQUIREMENTS> have been met and which ones have not been satisfied.
+Your response should be formatted in JSON with two keys:
+1. ANALYSIS: A paragraph of analysis (be in a string format). No longer than 150 words.
+2. SCORE: An integer score from 0 to 100. A score of 0 indicates that most of the <REQUIREMENTS> have not been met or are insufficiently detailed. In contrast, a score of 100 suggests that the majority of the <REQUIREMENTS> have been met and are accompanied by specific details.
 
-These are the <REQUIREMENTS> that outline the necessary components for high-quality disclosure pertaining to the <CRITICAL_ELEMENT>:
+<CRITICAL_ELEMENT>: {question}
 
 <REQUIREMENTS>:
 ====
 {requirements}
 ====
 
-Presented below are select excerpts from the sustainability report, which pertain to the <CRITICAL_ELEMENT>:
-
-<DISCLOSURE>:
-====
-{disclosure}
-====
-
-Please analyze the extent to which the given <DISCLOSURE> satisfies the aforementioned <REQUIREMENTS>. Your ANALYSIS should specify which <REQUIREMENTS> have been met and which ones have not been satisfied.
-Your response should be formatted in JSON with two keys:
-1. ANALYSIS: A paragraph of analysis (be in a string format). No longer than 150 words.
-2. SCORE: An integer score from 0 to 100. A score of 0 indicates that most of the <REQUIREMENTS> have not been met or are insufficiently detailed. In contrast, a score of 100 suggests that the majority of the <REQUIREMENTS> have been met and are accompanied by specific details.
-
 Your FINAL_ANSWER in JSON (ensure there's no format error):
 """,
     'scoring': """Your task is to rate the disclosure quality of a sustainability report. You'll be provided with a <REPORT SUMMARY> that contains {question_number} (DISCLOSURE_REQUIREMENT, DISCLOSURE_CONTENT) pairs. DICLOSURE_REQUIREMENT corresponds to a key piece of information that the report should disclose. DISCLOSURE_CONTENT summarizes the report's disclosed information on that topic. 
@@ -295,15 +292,43 @@ def remove_brackets(string):
     return re.sub(r'\([^)]*\)', '', string).strip()
 
 
+def _doc_block(doc, with_source=True):
+    output = "Content: {}\n".format(doc.page_content)
+    if with_source:
+        output += "Source: {}\n".format(doc.metadata['source'])
+    return output + "\n---\n"
+
+
 def _docs_to_string(docs, num_docs=TOP_K, with_source=True):
-    output = ""
-    docs = docs[:num_docs]
-    for doc in docs:
-        output += "Content: {}\n".format(doc.page_content)
-        if with_source:
-            output += "Source: {}\n".format(doc.metadata['source'])
-        output += "\n---\n"
-    return output
+    return "".join(_doc_block(doc, with_source) for doc in docs[:num_docs])
+
+
+def _context_blocks(report, key):
+    """
+    rendered chunks retrieved for a key, rendered once per report and shared by its QA and assessment prompts;
+    both prompts start with them, so that the two requests of a key share a prefix the provider can cache
+    """
+    if key not in report.context_blocks:
+        report.context_blocks[key] = [_doc_block(doc) for doc in report.section_text_dict[key][:TOP_K]]
+    return report.context_blocks[key]
+
+
+def _prompt_shrinker(build_message, num_docs):
+    """
+    fallback for prompts rejected for exceeding the context window of the model
+    :param build_message: function mapping a number of chunks to the message
+    :param num_docs: number of chunks in the message that was sent
+    :return: function returning the message with CONTEXT_FALLBACK_STEP chunks less on every call, None once empty
+    """
+    state = {'num_docs': num_docs}
+
+    def shrink():
+        state['num_docs'] -= CONTEXT_FALLBACK_STEP
+        if state['num_docs'] <= 0:
+            return None
+        return build_message(state['num_docs'])
+
+    return shrink
 
 
 def _find_answer(string, name="ANSWER"):
@@ -335,6 +360,14 @@ def _find_score(string):
     return d[0]
 
 
+def _to_score(score):
+    """ :return: the score as a float, None if it is not a number """
+    try:
+        return float(score)
+    except (TypeError, ValueError):
+        return None
+
+
 class Reader:
     def __init__(self, llm_name='gpt-3.5-turbo', answer_key_name='ANSWER', max_token=512, q_name='Q', a_name='A',
                  queries=QUERIES, qa_prompt='tcfd_qa_source', guidelines=TCFD_GUIDELINES,
@@ -342,15 +375,26 @@ class Reader:
                  answer_length='60',
                  root_path='./',
                  gitee_key='',
-                 user_name='defualt', language='en'):
+                 user_name='defualt', language='en', max_concurrency=MAX_CONCURRENCY, stage=None, llm_client=None):
+        """
+        :param stage: function returning a context manager for a named stage ('prompt_build', 'llm', 'parsing',
+                      'render'), entered around that part of every report; spans of the tracer by default,
+                      StageRecorder.stage of benchmark.py for benchmarks
+        :param llm_client: LLMClient shared with other readers, so that all their requests count against one
+                           max_concurrency; a client of its own if not given
+        """
         self.user_name = user_name  # user name
         self.language = language
         self.root_path = root_path
         self.max_token = max_token
         self.llm_name = llm_name
+        self.stage = stage if stage is not None else self._trace_stage
         #
-        self.tiktoken_encoder = tiktoken.encoding_for_model(self.llm_name)
+        self.tiktoken_encoder = get_encoder(self.llm_name)
         self.cur_api = 0
+        self.llm_client = llm_client if llm_client is not None else \
+            LLMClient(self.llm_name, max_concurrency=max_concurrency)
+        self.packer = ContextPacker(self.llm_name, encoder=self.tiktoken_encoder)
         self.file_format = 'md'  # or 'txt'
         self.prompts = PROMPTS
         self.assessments = assessments
@@ -372,9 +416,79 @@ class Reader:
         # else:
         #    self.gitee_key = ''
 
+    async def _agenerate(self, messages, max_tokens=512, shrinkers=None, keys=None, on_failure=None):
+        """
+        :param on_failure: function from the exception of a request that failed for good to the output text standing
+                           in for its answer; without one, a failure is raised once all requests are done
+        """
+        outputs = await self.llm_client.agenerate(messages, max_tokens=max_tokens, shrinkers=shrinkers, keys=keys)
+        for i, output in enumerate(outputs):
+            if isinstance(output, BaseException):
+                if on_failure is None or not isinstance(output, Exception):
+                    raise output
+                print('request {} failed: {!r}'.format(keys[i] if keys else i, output))
+                outputs[i] = on_failure(output)
+        return outputs
+
+    def _trace_stage(self, name):
+        return get_tracer().span(name, model=self.llm_name)
+
+    def _to_message(self, prompt):
+        if "turbo" in self.llm_name:
+            return [
+                SystemMessage(content=SYSTEM_PROMPT),
+                HumanMessage(content=prompt)
+            ]
+        return prompt
+
+    def _num_docs(self, fixed_prompt, blocks, max_tokens=512):
+        """ number of leading rendered chunks that fit into the prompt, fixed_prompt is rendered without chunks """
+        return self.packer.fit(fixed_prompt, blocks, max_tokens=max_tokens,
+                               system_prompt=SYSTEM_PROMPT if "turbo" in self.llm_name else None)
+
     async def qa_with_chat(self, report_list):
+        # reports are processed concurrently, each one starts its questions as soon as its basic info is in
+        results = await asyncio.gather(*[self._qa_report(report) for report in report_list])
+        htmls = []
+        for basic_info_dict, answers, html in results:
+            self.basic_info_answers.append(basic_info_dict)
+            self.answers.append(answers)
+            htmls.append(html)
+        return htmls
+
+    async def analyze_with_chat(self, report_list):
+        results = await asyncio.gather(*[self._analyze_report(report) for report in report_list])
         htmls = []
-        for report_index, report in enumerate(report_list):
+        for assessments, html in results:
+            self.assessment_results.append(assessments)
+            htmls.append(html)
+        return htmls
+
+    async def qa_and_analyze_with_chat(self, report_list):
+        """
+        run the TCFD question answering and the conformity analysis of every report together,
+        the analysis does not depend on the answers so both batches are in flight at the same time
+        :return: (htmls of the QA, htmls of the analysis)
+        """
+        # QA coroutines are started first, so every report's basic-info request is queued before the assessments
+        num_reports = len(report_list)
+        results = await asyncio.gather(*[self._qa_report(report) for report in report_list],
+                                       *[self._analyze_report(report) for report in report_list])
+        qa_htmls = []
+        analysis_htmls = []
+        for basic_info_dict, answers, html in results[:num_reports]:
+            self.basic_info_answers.append(basic_info_dict)
+            self.answers.append(answers)
+            qa_htmls.append(html)
+        for assessments, html in results[num_reports:]:
+            self.assessment_results.append(assessments)
+            analysis_htmls.append(html)
+        return qa_htmls, analysis_htmls
+
+    async def _qa_report(self, report):
+        # runs as a task of its own (asyncio.gather), the report only tags the spans of this task
+        set_trace_context(report=report.report_id, task='qa')
+        with self.stage('prompt_build'):
             basic_info_prompt = PromptTemplate(template=self.prompts['general'], input_variables=["context"])
             if "turbo" in self.llm_name:
                 # title = "Title: " + report.title + '\n'
@@ -384,13 +498,15 @@ class Reader:
                     HumanMessage(content=basic_info_prompt.format(
                         context=_docs_to_string(report.section_text_dict['general'], with_source=False)))
                 ]
-                llm = ChatOpenAI(temperature=0, max_tokens=256)
-                output_text = llm(message).content
             else:
                 message = basic_info_prompt.format(
                     context=_docs_to_string(report.section_text_dict['general'], with_source=False))
-                llm = OpenAI(temperature=0, max_tokens=256)
-                output_text = llm(message)
+        with self.stage('llm'):
+            # without basic info the questions are still answered, with the company unknown
+            output_text = (await self._agenerate(
+                [message], max_tokens=256, keys=['general'], on_failure=lambda e: json.dumps(
+                    {'COMPANY_NAME': 'unknown', 'COMPANY_SECTOR': 'unknown', 'COMPANY_LOCATION': 'unknown'})))[0]
+        with self.stage('parsing'):
             print(output_text)
             try:
                 basic_info_dict = json.loads(output_text)
@@ -401,8 +517,8 @@ class Reader:
             basic_info_string = """Company name: {name}\nCompany sector: {sector}\nCompany Location: {location}""" \
                 .format(name=basic_info_dict['COMPANY_NAME'], sector=basic_info_dict['COMPANY_SECTOR'],
                         location=basic_info_dict['COMPANY_LOCATION'])
-            self.basic_info_answers.append(basic_info_dict)
 
+        with self.stage('prompt_build'):
             tcfd_questions = {k: v for k, v in self.queries.items() if 'tcfd' in k}
             tcfd_prompt = PromptTemplate(template=self.prompts[self.qa_prompt],
                                          input_variables=["basic_info", "summaries", "question", "guidelines",
@@ -410,31 +526,29 @@ class Reader:
             answers = {}
             messages = []
             keys = []
+            shrinkers = []
             for k, q in tcfd_questions.items():
-                num_docs = 20
-                current_prompt = tcfd_prompt.format(basic_info=basic_info_string,
-                                                    summaries=_docs_to_string(report.section_text_dict[k]),
-                                                    question=q, guidelines=self.guidelines[k],
-                                                    answer_length=self.answer_length)
-                if '16k' not in self.llm_name:
-                    while len(self.tiktoken_encoder.encode(current_prompt)) > 3500 and num_docs > 10:
-                        num_docs -= 1
-                        current_prompt = tcfd_prompt.format(basic_info=basic_info_string, summaries=_docs_to_string(report.section_text_dict[k], num_docs=num_docs), question=q, guidelines=self.guidelines[k], answer_length=self.answer_length)
-                if "turbo" in self.llm_name:
-                    message = [
-                        SystemMessage(content=SYSTEM_PROMPT),
-                        HumanMessage(content=current_prompt)
-                    ]
-                else:
-                    message = current_prompt
+                blocks = _context_blocks(report, k)
+                num_docs = self._num_docs(tcfd_prompt.format(basic_info=basic_info_string, summaries='', question=q,
+                                                             guidelines=self.guidelines[k],
+                                                             answer_length=self.answer_length), blocks)
                 keys.append(k)
-                messages.append(message)
-            if "turbo" in self.llm_name:
-                llm = ChatOpenAI(temperature=0, max_tokens=512)
-            else:
-                llm = OpenAI(temperature=0, max_tokens=512)
-            outputs = await llm.agenerate(messages)
-            output_texts = {k: g[0].text for k, g in zip(keys, outputs.generations)}
+                messages.append(self._to_message(tcfd_prompt.format(basic_info=basic_info_string,
+                                                                     summaries="".join(blocks[:num_docs]),
+                                                                     question=q, guidelines=self.guidelines[k],
+                                                                     answer_length=self.answer_length)))
+                shrinkers.append(_prompt_shrinker(
+                    lambda n, k=k, q=q, blocks=blocks: self._to_message(tcfd_prompt.format(
+                        basic_info=basic_info_string, summaries="".join(blocks[:n]),
+                        question=q, guidelines=self.guidelines[k], answer_length=self.answer_length)),
+                    num_docs))
+        with self.stage('llm'):
+            # a question whose request failed gets a placeholder answer, the other answers are kept
+            outputs = await self._agenerate(messages, shrinkers=shrinkers, keys=keys, on_failure=lambda e: json.dumps(
+                {self.answer_key_name: 'No answer, the request failed: {}.'.format(type(e).__name__),
+                 'SOURCES': []}))
+        with self.stage('parsing'):
+            output_texts = {k: text for k, text in zip(keys, outputs)}
 
             for k, text in output_texts.items():
                 try:
@@ -453,8 +567,8 @@ class Reader:
                 answers[k]['PAGE'] = list(set(page_source))
                 answers[k][self.answer_key_name] = remove_brackets(answers[k][self.answer_key_name])
                 print(answers[k])
-            self.answers.append(answers)
 
+        with self.stage('render'):
             questionnaire_governance = ""
             questionnaire_strategy = ""
             questionnaire_risk = ""
@@ -488,50 +602,41 @@ class Reader:
                     questionnaire_metrics += self.a_name + "{}: {}\n\n".format(int(idx + 1),
                                                                                answers[k][self.answer_key_name])
                     questionnaire_metrics += "\n"
-            questionnaire = questionnaire_governance + questionnaire_strategy + questionnaire_risk + questionnaire_metrics
+            questionnaire = questionnaire_governance + questionnaire_strategy + questionnaire_risk + \
+                questionnaire_metrics
+            html = markdown.markdown(questionnaire)
 
-            htmls.append(markdown.markdown(questionnaire))
-        return htmls
+        return basic_info_dict, answers, html
 
-    async def analyze_with_chat(self, report_list):
-        htmls = []
-        for report_index, report in enumerate(report_list):
+    async def _analyze_report(self, report):
+        set_trace_context(report=report.report_id, task='analysis')
+        with self.stage('prompt_build'):
             tcfd_assessment_prompt = PromptTemplate(template=self.prompts['tcfd_assessment'],
                                                     input_variables=["question", "requirements", "disclosure"])
             tcfd_questions = {k: v for k, v in self.queries.items() if 'tcfd' in k}
             assessments = {}
             messages = []
             keys = []
+            shrinkers = []
             for idx, k in enumerate(self.assessments.keys()):
-                num_docs = 20
-                current_prompt = tcfd_assessment_prompt.format(question=self.queries[k],
-                                                               requirements=self.assessments[k],
-                                                               disclosure=_docs_to_string(
-                                                                   report.section_text_dict[k], with_source=False))
-                if '16k' not in self.llm_name:
-                    while len(self.tiktoken_encoder.encode(current_prompt)) > 3200 and num_docs > 10:
-                        num_docs -= 1
-                        current_prompt = tcfd_assessment_prompt.format(question=self.queries[k],
-                                                                       requirements=self.assessments[k],
-                                                                       disclosure=_docs_to_string(
-                                                                           report.section_text_dict[k],
-                                                                           num_docs=num_docs,
-                                                                           with_source=False))
-                if "turbo" in self.llm_name:
-                    message = [
-                        SystemMessage(content=SYSTEM_PROMPT),
-                        HumanMessage(content=current_prompt)
-                    ]
-                else:
-                    message = current_prompt
+                # same rendered chunks as the QA prompt of the key
+                blocks = _context_blocks(report, k)
+                num_docs = self._num_docs(tcfd_assessment_prompt.format(question=self.queries[k],
+                                                                        requirements=self.assessments[k],
+                                                                        disclosure=''), blocks)
                 keys.append(k)
-                messages.append(message)
-            if "turbo" in self.llm_name:
-                llm = ChatOpenAI(temperature=0, max_tokens=512)
-            else:
-                llm = OpenAI(temperature=0, max_tokens=512)
-            outputs = await llm.agenerate(messages)
-            output_texts = {k: g[0].text for k, g in zip(keys, outputs.generations)}
+                messages.append(self._to_message(tcfd_assessment_prompt.format(
+                    question=self.queries[k], requirements=self.assessments[k],
+                    disclosure="".join(blocks[:num_docs]))))
+                shrinkers.append(_prompt_shrinker(
+                    lambda n, k=k, blocks=blocks: self._to_message(tcfd_assessment_prompt.format(
+                        question=self.queries[k], requirements=self.assessments[k], disclosure="".join(blocks[:n]))),
+                    num_docs))
+        with self.stage('llm'):
+            outputs = await self._agenerate(messages, shrinkers=shrinkers, keys=keys, on_failure=lambda e: json.dumps(
+                {'ANALYSIS': 'No analysis, the request failed: {}.'.format(type(e).__name__), 'SCORE': 'N/A'}))
+        with self.stage('parsing'):
+            output_texts = {k: text for k, text in zip(keys, outputs)}
 
             for k, text in output_texts.items():
                 try:
@@ -550,8 +655,8 @@ class Reader:
                     analysis_text = analysis_text.replace("<REQUIREMENTS>", "TCFD guidelines")
                 assessments[k]['ANALYSIS'] = analysis_text
                 print(assessments[k])
-            self.assessment_results.append(assessments)
 
+        with self.stage('render'):
             questionnaire_governance = ""
             questionnaire_strategy = ""
             questionnaire_risk = ""
@@ -585,11 +690,11 @@ class Reader:
                     questionnaire_metrics += "Analysis{}: {}\n\n".format(int(idx + 1), assessments[k]['ANALYSIS'])
                     questionnaire_metrics += "Score{}: {}\n\n".format(int(idx + 1), assessments[k]['SCORE'])
                     questionnaire_metrics += "\n"
-            questionnaire = questionnaire_governance + questionnaire_strategy + questionnaire_risk + questionnaire_metrics
-            all_scores = [float(s['SCORE']) for s in assessments.values()]
-
-            htmls.append(markdown.markdown(questionnaire + '\n\n' + "Average score: {}".format(sum(all_scores) / 11)))
-        return htmls
-           
-
-
+            questionnaire = questionnaire_governance + questionnaire_strategy + questionnaire_risk + \
+                questionnaire_metrics
+            # assessments whose request failed have no score ('N/A') and are left out of the average
+            all_scores = [score for score in (_to_score(s['SCORE']) for s in assessments.values()) if score is not None]
+            average_score = sum(all_scores) / len(all_scores) if all_scores else 'N/A'
+            html = markdown.markdown(questionnaire + '\n\n' + "Average score: {}".format(average_score))
+
+        return assessments, html
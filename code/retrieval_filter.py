@@ -0,0 +1,116 @@
+"""
+ post-processing of retrieved chunks before they go into prompts: chunks below the similarity threshold and
+ duplicate or near-duplicate chunks (boilerplate repeated across pages, chunks retrieved by several queries,
+ neighbouring chunks covering the same text) are dropped, and the prompt tokens this saves are counted
+"""
+import re
+import threading
+
+import cfg
+from llm_client import get_encoder
+
+# chunks are compared by their sets of word n-grams of this length
+SHINGLE_SIZE = 3
+
+
+def similarity(distance):
+    """ cosine similarity from the squared L2 distance of unit-length embeddings (OpenAI embeddings are) """
+    return 1. - distance / 2.
+
+
+def default_similarity_threshold():
+    """ the threshold of the embedding model in use, similarities of different models are not comparable """
+    return cfg.local_similarity_threshold if cfg.embedding_backend == 'local' else cfg.similarity_threshold
+
+
+def _shingles(text):
+    words = re.findall(r'\w+', text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)}
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+class RetrievalFilter:
+    def __init__(self, similarity_threshold=None, duplicate_threshold=cfg.near_duplicate_threshold,
+                 min_chunks=cfg.similarity_min_chunks, encoder=None):
+        """
+        :param similarity_threshold: chunks less similar to the query are dropped, unless fewer than min_chunks
+                                     would be left; by default the threshold of the embedding model in use
+        :param duplicate_threshold: a chunk is a near-duplicate of a better ranked one if this share of the word
+                                    n-grams of the shorter of the two occurs in both
+        """
+        self.similarity_threshold = similarity_threshold if similarity_threshold is not None \
+            else default_similarity_threshold()
+        self.duplicate_threshold = duplicate_threshold
+        self.min_chunks = min_chunks
+        self.encoder = encoder if encoder is not None else get_encoder()
+        self.num_chunks = 0
+        self.num_below_threshold = 0
+        self.num_duplicates = 0
+        self.num_tokens = 0
+        self.num_tokens_removed = 0
+        self._lock = threading.Lock()
+
+    def _is_duplicate(self, shingles, kept_shingles):
+        for other in kept_shingles:
+            if len(shingles & other) >= self.duplicate_threshold * min(len(shingles), len(other)):
+                return True
+        return False
+
+    def filter(self, results):
+        """
+        :param results: (document, distance) pairs in ranking order
+        :return: documents kept, in the same order
+        """
+        return self.filter_merged([results])
+
+    def filter_merged(self, result_lists):
+        """
+        the results of several queries merged into one list: the threshold (and min_chunks) applies to the results
+        of each query on its own, duplicates are removed across all of them
+        :param result_lists: per query, (document, distance) pairs in ranking order
+        :return: documents kept, query by query in ranking order
+        """
+        kept = []
+        kept_keys = set()
+        kept_shingles = []
+        num_chunks = below_threshold = duplicates = tokens_removed = tokens = 0
+        for results in result_lists:
+            num_chunks += len(results)
+            kept_of_query = 0
+            for doc, distance in results:
+                num_tokens = len(self.encoder.encode(doc.page_content))
+                tokens += num_tokens
+                # the same chunk retrieved by several queries, or the same text on several pages
+                key = ' '.join(doc.page_content.split())
+                if key in kept_keys:
+                    duplicates += 1
+                    tokens_removed += num_tokens
+                    continue
+                if similarity(distance) < self.similarity_threshold and kept_of_query >= self.min_chunks:
+                    below_threshold += 1
+                    tokens_removed += num_tokens
+                    continue
+                shingles = _shingles(doc.page_content)
+                if self._is_duplicate(shingles, kept_shingles):
+                    duplicates += 1
+                    tokens_removed += num_tokens
+                    continue
+                kept.append(doc)
+                kept_keys.add(key)
+                kept_shingles.append(shingles)
+                kept_of_query += 1
+        with self._lock:
+            self.num_chunks += num_chunks
+            self.num_below_threshold += below_threshold
+            self.num_duplicates += duplicates
+            self.num_tokens += tokens
+            self.num_tokens_removed += tokens_removed
+        return kept
+
+    def stats(self):
+        """ tokens_removed: tokens of the dropped chunks, saved in every prompt built from their retrieval """
+        with self._lock:
+            return {'chunks': self.num_chunks, 'below_threshold': self.num_below_threshold,
+                    'duplicates': self.num_duplicates, 'tokens': self.num_tokens,
+                    'tokens_removed': self.num_tokens_removed}
@@ -0,0 +1,196 @@
+"""
+ structured tracing of production runs: every pipeline stage of Report, Reader and UserQA and every LLM request is a
+ span with its stage, latency and attributes (report, question key, model, tokens in / out, cached tokens, retries,
+ cache hits). Finished spans go to the exporters of cfg.tracing_exporters: 'jsonl' appends one JSON object per span
+ to cfg.tracing_jsonl_path, 'prometheus' aggregates spans into counters in the Prometheus text format, served on
+ cfg.tracing_prometheus_host:cfg.tracing_prometheus_port (and on /metrics of qa_server.py)
+"""
+import json
+import time
+import threading
+import contextlib
+import contextvars
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import cfg
+
+# attributes of the enclosing trace_context, every asyncio task starts with a copy of its creator's
+_context = contextvars.ContextVar('trace_context', default={})
+
+
+@contextlib.contextmanager
+def trace_context(**attributes):
+    """ add attributes (e.g. report) to every span started inside, including spans of coroutines started inside """
+    token = _context.set(dict(_context.get(), **attributes))
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def set_trace_context(**attributes):
+    """ add attributes to the spans of the rest of the current task (or thread), for coroutines run as tasks """
+    _context.set(dict(_context.get(), **attributes))
+
+
+class Span:
+    def __init__(self, stage, attributes):
+        self.stage = stage
+        self.attributes = attributes
+        self.start = time.time()
+        self.latency = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, **counts):
+        """ add to numeric attributes, e.g. tokens of several attempts """
+        for name, count in counts.items():
+            self.attributes[name] = self.attributes.get(name, 0) + count
+
+    def to_dict(self):
+        record = dict(self.attributes, stage=self.stage, start=round(self.start, 6), latency=round(self.latency, 6),
+                      status='error' if self.error else 'ok')
+        if self.error:
+            record['error'] = self.error
+        return record
+
+
+class Tracer:
+    def __init__(self, exporters=()):
+        self.exporters = list(exporters)
+
+    @contextlib.contextmanager
+    def span(self, stage, **attributes):
+        """ :return: context manager yielding the span, attributes can be set on it until it ends """
+        span = Span(stage, dict(_context.get(), **{k: v for k, v in attributes.items() if v is not None}))
+        start_time = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            span.latency = time.perf_counter() - start_time
+            for exporter in self.exporters:
+                exporter.export(span)
+
+    def exporter(self, exporter_class):
+        """ :return: the exporter of the given class, None if there is none """
+        return next((e for e in self.exporters if isinstance(e, exporter_class)), None)
+
+
+class JsonLinesExporter:
+    def __init__(self, path=cfg.tracing_jsonl_path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str) + '\n'
+        # opened per span, so that several processes can append to the same file
+        with self._lock, open(self.path, 'a') as f:
+            f.write(line)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class PrometheusExporter:
+    """ counters per stage and model (reports and questions are left out, they would make a series each) """
+    # metric name, help text, attribute summed (None: one per span)
+    METRICS = (
+        ('chatreport_spans_total', 'Spans finished', None),
+        ('chatreport_span_errors_total', 'Spans ended by an exception', 'errors'),
+        ('chatreport_span_seconds_total', 'Seconds spent in spans', 'latency'),
+        ('chatreport_input_tokens_total', 'Prompt tokens sent', 'tokens_in'),
+        ('chatreport_cached_input_tokens_total', 'Prompt tokens served from the prompt-prefix cache', 'cached_tokens'),
+        ('chatreport_output_tokens_total', 'Completion tokens received', 'tokens_out'),
+        ('chatreport_retries_total', 'Requests sent again after a transient error', 'retries'),
+        ('chatreport_cache_hits_total', 'Requests served from the LLM or embedding cache', 'cache_hits'),
+    )
+
+    def __init__(self):
+        self.series = {}  # (stage, model) -> summed attributes
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        key = (span.stage, span.attributes.get('model', ''))
+        with self._lock:
+            series = self.series.setdefault(key, {})
+            series['spans'] = series.get('spans', 0) + 1
+            series['errors'] = series.get('errors', 0) + (1 if span.error else 0)
+            series['latency'] = series.get('latency', 0.) + span.latency
+            for _, _, attribute in self.METRICS[3:]:
+                value = span.attributes.get(attribute)
+                if isinstance(value, (int, float)):
+                    series[attribute] = series.get(attribute, 0) + value
+
+    def render(self):
+        """ :return: all metrics in the Prometheus text exposition format """
+        with self._lock:
+            series = {key: dict(values) for key, values in self.series.items()}
+        lines = []
+        for name, help_text, attribute in self.METRICS:
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} counter'.format(name))
+            for (stage, model), values in sorted(series.items()):
+                value = values.get(attribute or 'spans', 0)
+                lines.append('{}{{stage="{}",model="{}"}} {}'.format(name, _escape(stage), _escape(model),
+                                                                    round(value, 6)))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=cfg.tracing_prometheus_port, host=cfg.tracing_prometheus_host):
+        """ serve GET /metrics from a daemon thread """
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                data = exporter.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        httpd = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        print('[tracing] metrics on http://{}:{}/metrics'.format(host, port))
+        return httpd
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer():
+    """ the process-wide tracer with the exporters of cfg, spans are measured but go nowhere if there are none """
+    global _tracer
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                exporters = []
+                for name in cfg.tracing_exporters:
+                    assert name in ('jsonl', 'prometheus'), "unknown tracing exporter {}".format(name)
+                    if name == 'jsonl':
+                        exporters.append(JsonLinesExporter(cfg.tracing_jsonl_path))
+                    else:
+                        exporter = PrometheusExporter()
+                        if cfg.tracing_prometheus_port:
+                            exporter.serve(cfg.tracing_prometheus_port, cfg.tracing_prometheus_host)
+                        exporters.append(exporter)
+                _tracer = Tracer(exporters)
+    return _tracer
+
+
+def set_tracer(tracer):
+    global _tracer
+    _tracer = tracer
@@ -1,23 +1,20 @@
 import os
-import configparser
+import asyncio
+import functools
 
-from langchain.llms import OpenAI
-from langchain.chat_models import ChatOpenAI
 from langchain.schema import (
     HumanMessage,
     SystemMessage
 )
 from langchain.prompts import PromptTemplate
-from reader import _find_answer, _find_sources, _docs_to_string, remove_brackets
+from reader import _find_answer, _find_sources, _doc_block, _docs_to_string, remove_brackets, _prompt_shrinker
+from llm_client import LLMClient, get_encoder
+from context_packer import ContextPacker
+from tracing import get_tracer, trace_context
 
 import cfg
 import json
-import tiktoken
 
-config = configparser.ConfigParser()
-config.read('apikey.ini')
-chat_api_list = config.get('OpenAI', 'OPENAI_API_KEYS')[1:-1].replace('\'', '').split(',')
-os.environ["OPENAI_API_KEY"] = chat_api_list[0]
 
 TOP_K = cfg.retriever_top_k
 PROMPTS = cfg.prompts
@@ -27,117 +24,193 @@ TCFD_GUIDELINES = cfg.tcfd_guidelines
 SYSTEM_PROMPT = cfg.system_prompt
 
 
+def _corpus_doc_block(doc, source):
+    # chunk numbers restart in every report, the chunks of a corpus-wide question are numbered by rank instead
+    report = doc.metadata['company']
+    if doc.metadata.get('year'):
+        report += ' ({})'.format(doc.metadata['year'])
+    return "Content: {}\nReport: {}\nSource: {}\n\n---\n".format(doc.page_content, report, source)
+
+
 class UserQA:
     def __init__(self, llm_name='gpt-3.5-turbo', answer_key_name='ANSWER', max_token=512,
                  root_path='./',
                  gitee_key='',
-                 user_name='defualt', language='en'):
+                 user_name='defualt', language='en', keep_history=True):
         self.user_name = user_name  # user name
         self.language = language
         self.root_path = root_path
         self.max_token = max_token
         self.llm_name = llm_name
         #
-        self.tiktoken_encoder = tiktoken.encoding_for_model(self.llm_name)
+        self.tiktoken_encoder = get_encoder(self.llm_name)
         self.cur_api = 0
+        self.llm_client = LLMClient(self.llm_name)
+        self.packer = ContextPacker(self.llm_name, encoder=self.tiktoken_encoder)
         self.prompts = PROMPTS
         self.answer_key_name = answer_key_name
         self.basic_info_answers = []
         self.user_questions = []
         self.user_answers = []
+        # a long-running server answers an unbounded number of questions and does not keep them
+        self.keep_history = keep_history
 
     def user_qa(self, question, report, basic_info_path, answer_length=60, prompt_template=None,
                 top_k=20):
-        if prompt_template is None:
-            prompt_template = self.prompts['user_qa_source']
-        # to_question_prompt = PromptTemplate(template=self.prompts['to_question'], input_variables=["statement"])
-        # to_question_message = [
-        #     SystemMessage(content="You are a helpful AI assistant."),
-        #     HumanMessage(content=to_question_prompt.format(statement=question))
-        # ]
-        # llm = ChatOpenAI(temperature=0)
-        # question = llm(to_question_message).content
+        return asyncio.run(self.auser_qa(question, report, basic_info_path, answer_length=answer_length,
+                                         prompt_template=prompt_template, top_k=top_k))
+
+    def _to_message(self, prompt):
+        if "turbo" in self.llm_name:
+            return [
+                SystemMessage(content=SYSTEM_PROMPT),
+                HumanMessage(content=prompt)
+            ]
+        return prompt
+
+    async def _basic_info(self, report, basic_info_path):
+        if report.basic_info is None:
+            report.basic_info = await self._load_basic_info(report, basic_info_path)
+        return report.basic_info
+
+    async def _load_basic_info(self, report, basic_info_path):
         if os.path.exists(basic_info_path):
             with open(basic_info_path, 'r') as f:
                 basic_info_dict = json.load(f)
-            basic_info_string = str(basic_info_dict)
-        else:
-            basic_info_prompt = PromptTemplate(template=self.prompts['general'], input_variables=["context"])
-            if "turbo" in self.llm_name:
-                # title = "Title: " + report.title + '\n'
-                # first_page = "First Page: " + report.pdf[0].get_text() + '\n'
-                message = [
-                    SystemMessage(content=SYSTEM_PROMPT),
-                    HumanMessage(content=basic_info_prompt.format(
-                        context=_docs_to_string(report.section_text_dict['general'], with_source=False)))
-                ]
-                llm = ChatOpenAI(temperature=0, max_tokens=256)
-                output_text = llm(message).content
-            else:
-                message = basic_info_prompt.format(
-                    context=_docs_to_string(report.section_text_dict['general'], with_source=False))
-                llm = OpenAI(temperature=0, max_tokens=256)
-                output_text = llm(message)
-            try:
-                basic_info_dict = json.loads(output_text)
-            except ValueError as e:
-                basic_info_dict = {'COMPANY_NAME': _find_answer(output_text, name='COMPANY_NAME'),
-                                   'COMPANY_SECTOR': _find_answer(output_text, name='COMPANY_SECTOR'),
-                                   'COMPANY_LOCATION': _find_answer(output_text, name='COMPANY_LOCATION')}
-            basic_info_string = str(basic_info_dict)
-            with open(basic_info_path, 'w') as f:
-                json.dump(basic_info_dict, f)
-            self.basic_info_answers.append(basic_info_dict)
-
-        self.user_questions.append(question)
-        # get the retriever, where the vector database is loaded from report.db_path
-        retriever, _ = report._get_retriever(report.db_path)
-        docs = retriever.get_relevant_documents(question)
-        tcfd_prompt = PromptTemplate(template=prompt_template,
-                                     input_variables=["basic_info", "summaries", "question", "answer_length"])
-        num_docs = top_k
-        current_prompt = tcfd_prompt.format(basic_info=basic_info_string,
-                                            summaries=_docs_to_string(docs),
-                                            question=question,
-                                            answer_length=str(answer_length))
-        if '16k' not in self.llm_name:
-            while len(self.tiktoken_encoder.encode(current_prompt)) > 3500 and num_docs > 10:
-                num_docs -= 1
-                current_prompt = tcfd_prompt.format(basic_info=self.basic_info_answers[0],
-                                                    summaries=_docs_to_string(docs, num_docs=num_docs),
-                                                    question=question,
-                                                    answer_length=str(answer_length))
+            return str(basic_info_dict)
+        basic_info_prompt = PromptTemplate(template=self.prompts['general'], input_variables=["context"])
         if "turbo" in self.llm_name:
+            # title = "Title: " + report.title + '\n'
+            # first_page = "First Page: " + report.pdf[0].get_text() + '\n'
             message = [
                 SystemMessage(content=SYSTEM_PROMPT),
-                HumanMessage(content=current_prompt)
+                HumanMessage(content=basic_info_prompt.format(
+                    context=_docs_to_string(report.section_text_dict['general'], with_source=False)))
             ]
-            llm = ChatOpenAI(temperature=0, max_tokens=512)
-            output_text = llm(message).content
         else:
-            message = current_prompt
-            llm = OpenAI(temperature=0, max_tokens=512)
-            output_text = llm(message)
+            message = basic_info_prompt.format(
+                context=_docs_to_string(report.section_text_dict['general'], with_source=False))
+        output_text = await self.llm_client.generate_one(message, max_tokens=256, key='general')
         try:
-            answer_dict = json.loads(output_text)
+            basic_info_dict = json.loads(output_text)
         except ValueError as e:
-            answer_dict = {self.answer_key_name: _find_answer(output_text, name=self.answer_key_name),
-                           'SOURCES': _find_sources(output_text)}
-        page_source = []
-        for s in answer_dict['SOURCES']:
+            basic_info_dict = {'COMPANY_NAME': _find_answer(output_text, name='COMPANY_NAME'),
+                               'COMPANY_SECTOR': _find_answer(output_text, name='COMPANY_SECTOR'),
+                               'COMPANY_LOCATION': _find_answer(output_text, name='COMPANY_LOCATION')}
+        with open(basic_info_path, 'w') as f:
+            json.dump(basic_info_dict, f)
+        if self.keep_history:
+            self.basic_info_answers.append(basic_info_dict)
+        return str(basic_info_dict)
+
+    async def auser_qa(self, question, report, basic_info_path, answer_length=60, prompt_template=None,
+                       top_k=20):
+        with trace_context(report=report.report_id), get_tracer().span('user_qa', model=self.llm_name):
+            if prompt_template is None:
+                prompt_template = self.prompts['user_qa_source']
+            # to_question_prompt = PromptTemplate(template=self.prompts['to_question'], input_variables=["statement"])
+            # to_question_message = [
+            #     SystemMessage(content="You are a helpful AI assistant."),
+            #     HumanMessage(content=to_question_prompt.format(statement=question))
+            # ]
+            # llm = ChatOpenAI(temperature=0)
+            # question = llm(to_question_message).content
+            if self.keep_history:
+                self.user_questions.append(question)
+            # the basic info request and the retrieval of the question are independent, run them side by side;
+            # the vector database of the report is loaded from report.db_path on first use
+            loop = asyncio.get_running_loop()
+            basic_info_string, docs = await asyncio.gather(
+                self._basic_info(report, basic_info_path),
+                loop.run_in_executor(None, report.retrieve, question))
+            tcfd_prompt = PromptTemplate(template=prompt_template,
+                                         input_variables=["basic_info", "summaries", "question", "answer_length"])
+            num_docs = self.packer.fit(
+                tcfd_prompt.format(basic_info=basic_info_string, summaries='', question=question,
+                                   answer_length=str(answer_length)),
+                [_doc_block(doc) for doc in docs[:top_k]], max_tokens=512,
+                system_prompt=SYSTEM_PROMPT if "turbo" in self.llm_name else None)
+            current_prompt = tcfd_prompt.format(basic_info=basic_info_string,
+                                                summaries=_docs_to_string(docs, num_docs=num_docs),
+                                                question=question,
+                                                answer_length=str(answer_length))
+            shrink = _prompt_shrinker(
+                lambda n: self._to_message(tcfd_prompt.format(basic_info=basic_info_string,
+                                                              summaries=_docs_to_string(docs, num_docs=n),
+                                                              question=question,
+                                                              answer_length=str(answer_length))),
+                num_docs)
+            output_text = await self.llm_client.generate_one(self._to_message(current_prompt), max_tokens=512,
+                                                             shrink=shrink, key='user_qa')
             try:
-                page_source.append(report.page_idx[s])
-            except Exception as e:
-                pass
-        used_chunks = []
-        for doc in docs:
-            if int(doc.metadata['source']) in answer_dict['SOURCES']:
-                used_chunks.append(doc.page_content)
-        answer_dict[self.answer_key_name] = remove_brackets(answer_dict[self.answer_key_name])
-        answer_dict['PAGE'] = list(set(page_source))
-        answer_dict['QUESTION'] = question
-        answer_dict['ANSWER_LENGTH'] = answer_length
-        answer_dict['USED_CHUNKS'] = used_chunks
-        self.user_answers.append(answer_dict)
-
-        return answer_dict, docs
+                answer_dict = json.loads(output_text)
+            except ValueError as e:
+                answer_dict = {self.answer_key_name: _find_answer(output_text, name=self.answer_key_name),
+                               'SOURCES': _find_sources(output_text)}
+            page_source = []
+            for s in answer_dict['SOURCES']:
+                try:
+                    page_source.append(report.page_idx[s])
+                except Exception as e:
+                    pass
+            used_chunks = []
+            for doc in docs:
+                if int(doc.metadata['source']) in answer_dict['SOURCES']:
+                    used_chunks.append(doc.page_content)
+            answer_dict[self.answer_key_name] = remove_brackets(answer_dict[self.answer_key_name])
+            answer_dict['PAGE'] = list(set(page_source))
+            answer_dict['QUESTION'] = question
+            answer_dict['ANSWER_LENGTH'] = answer_length
+            answer_dict['USED_CHUNKS'] = used_chunks
+            if self.keep_history:
+                self.user_answers.append(answer_dict)
+
+            return answer_dict, docs
+
+    def corpus_qa(self, question, global_index, answer_length=60, top_k=20, reports=None, companies=None,
+                  years=None, max_per_report=cfg.global_qa_max_per_report):
+        return asyncio.run(self.acorpus_qa(question, global_index, answer_length=answer_length, top_k=top_k,
+                                           reports=reports, companies=companies, years=years,
+                                           max_per_report=max_per_report))
+
+    async def acorpus_qa(self, question, global_index, answer_length=60, top_k=20, reports=None, companies=None,
+                         years=None, max_per_report=cfg.global_qa_max_per_report):
+        """
+        answer a question from the chunks of all reports of a GlobalIndex, or of the reports matching the filters
+        :param max_per_report: chunks per report, so that the context covers more than the best matching report
+        """
+        with get_tracer().span('corpus_qa', model=self.llm_name, reports=len(global_index)):
+            if self.keep_history:
+                self.user_questions.append(question)
+            loop = asyncio.get_running_loop()
+            results = await loop.run_in_executor(None, functools.partial(
+                global_index.search, question, k=top_k, reports=reports, companies=companies, years=years,
+                max_per_report=max_per_report))
+            docs = [doc for doc, _ in results]
+            blocks = [_corpus_doc_block(doc, i) for i, doc in enumerate(docs)]
+            corpus_prompt = PromptTemplate(template=self.prompts['corpus_qa_source'],
+                                           input_variables=["summaries", "question", "answer_length"])
+            num_docs = self.packer.fit(
+                corpus_prompt.format(summaries='', question=question, answer_length=str(answer_length)),
+                blocks, max_tokens=512, system_prompt=SYSTEM_PROMPT if "turbo" in self.llm_name else None)
+            build_message = lambda n: self._to_message(corpus_prompt.format(
+                summaries="".join(blocks[:n]), question=question, answer_length=str(answer_length)))
+            output_text = await self.llm_client.generate_one(build_message(num_docs), max_tokens=512,
+                                                             shrink=_prompt_shrinker(build_message, num_docs),
+                                                             key='corpus_qa')
+            try:
+                answer_dict = json.loads(output_text)
+            except ValueError as e:
+                answer_dict = {self.answer_key_name: _find_answer(output_text, name=self.answer_key_name),
+                               'SOURCES': _find_sources(output_text)}
+            used_docs = [docs[s] for s in answer_dict['SOURCES'] if isinstance(s, int) and 0 <= s < num_docs]
+            answer_dict[self.answer_key_name] = remove_brackets(answer_dict[self.answer_key_name])
+            answer_dict['REPORTS'] = [{'REPORT': doc.metadata['report'], 'COMPANY': doc.metadata['company'],
+                                       'YEAR': doc.metadata['year'], 'PAGE': doc.metadata['page']} for doc in used_docs]
+            answer_dict['QUESTION'] = question
+            answer_dict['ANSWER_LENGTH'] = answer_length
+            answer_dict['USED_CHUNKS'] = [doc.page_content for doc in used_docs]
+            if self.keep_history:
+                self.user_answers.append(answer_dict)
+
+            return answer_dict, docs
@@ -0,0 +1,240 @@
+"""
+ FAISS indexes of selectable type (cfg.faiss_index_type) behind langchain's FAISS vector store,
+ stored in the usual db_path layout (index.faiss, index.pkl), or memory-mapped vector databases
+ (cfg.vector_storage = 'mmap', see mapped_store.py); run as a script to compare recall@k and latency
+ of the index types against exact search
+"""
+import os
+import json
+import math
+import time
+import uuid
+import argparse
+
+import faiss
+import numpy as np
+from langchain.vectorstores import FAISS
+from langchain.docstore.document import Document
+from langchain.docstore.in_memory import InMemoryDocstore
+
+import cfg
+from mapped_store import MappedVectorStore, is_mapped, load_mapped_vectors
+
+# id and dimension of the embedding model of a vector database
+EMBEDDING_META_FILE = 'embedding.json'
+INDEX_TYPES = ('flat', 'ivf', 'hnsw', 'pq', 'ivfpq')
+# k-means wants at least this many training vectors per centroid
+TRAIN_POINTS_PER_CENTROID = 39
+# bits per pq code; indexes too small to train 256 centroids per sub-quantizer are flat, codes of fewer bits
+# lose most of the recall
+PQ_BITS = 8
+
+
+def _pq_params(num_vectors, dim):
+    m = max(d for d in range(1, min(cfg.faiss_pq_m, dim) + 1) if dim % d == 0)
+    # every sub-quantizer trains 2**nbits centroids on num_vectors points
+    centroids = num_vectors // TRAIN_POINTS_PER_CENTROID
+    nbits = min(PQ_BITS, int(math.log2(centroids))) if centroids > 1 else 0
+    return m, nbits
+
+
+def index_factory_string(index_type, num_vectors, dim):
+    """ faiss.index_factory description of the index type, scaled down to what num_vectors can train """
+    assert index_type in INDEX_TYPES, "unknown index type {}".format(index_type)
+    nlist = max(1, min(cfg.faiss_nlist, num_vectors // TRAIN_POINTS_PER_CENTROID))
+    if index_type == 'ivf':
+        return 'IVF{},Flat'.format(nlist)
+    if index_type == 'hnsw':
+        return 'HNSW{}'.format(cfg.faiss_hnsw_m)
+    if index_type in ('pq', 'ivfpq'):
+        m, nbits = _pq_params(num_vectors, dim)
+        if nbits < PQ_BITS:
+            return 'Flat'
+        prefix = 'IVF{},'.format(nlist) if index_type == 'ivfpq' else ''
+        return '{}PQ{}x{}'.format(prefix, m, nbits)
+    return 'Flat'
+
+
+def set_search_params(index):
+    """ query-time parameters are not stored with the index, they are set again after building and loading """
+    try:
+        faiss.extract_index_ivf(index).nprobe = cfg.faiss_nprobe
+    except RuntimeError:  # not an ivf index
+        pass
+    if hasattr(index, 'hnsw'):
+        index.hnsw.efSearch = cfg.faiss_ef_search
+    return index
+
+
+def search_parameters(index, selector):
+    """
+    search parameters restricting a search to the ids of the selector, with the query-time parameters of cfg
+    :return: None if the index type cannot filter ids while searching (pq)
+    """
+    try:
+        faiss.extract_index_ivf(index)
+        return faiss.SearchParametersIVF(sel=selector, nprobe=cfg.faiss_nprobe)
+    except RuntimeError:  # not an ivf index
+        pass
+    if hasattr(index, 'hnsw'):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=cfg.faiss_ef_search)
+    if isinstance(index, faiss.IndexPQ):
+        return None
+    return faiss.SearchParameters(sel=selector)
+
+
+def build_index(vectors, index_type=None):
+    """ :param vectors: float32 matrix, one row per chunk """
+    index_type = index_type or cfg.faiss_index_type
+    num_vectors, dim = vectors.shape
+    index = faiss.index_factory(dim, index_factory_string(index_type, num_vectors, dim), faiss.METRIC_L2)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    return set_search_params(index)
+
+
+def build_vector_store(texts, embeddings, metadatas=None, index_type=None, vectors=None):
+    """
+    drop-in for FAISS.from_texts with the index type of cfg (or the one given), or the mapped store of cfg
+    :param vectors: embeddings of the texts if they are embedded already (e.g. during extraction)
+    """
+    if cfg.vector_storage == 'mmap':
+        return MappedVectorStore.from_texts(texts, embeddings, metadatas=metadatas, vectors=vectors)
+    if vectors is None:
+        vectors = embeddings.embed_documents(texts)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    index = build_index(vectors, index_type=index_type)
+    ids = [str(uuid.uuid4()) for _ in texts]
+    documents = [Document(page_content=text, metadata=metadatas[i] if metadatas else {})
+                 for i, text in enumerate(texts)]
+    docstore = InMemoryDocstore(dict(zip(ids, documents)))
+    return FAISS(embeddings.embed_query, index, docstore, dict(enumerate(ids)))
+
+
+def embedding_model_id(embeddings):
+    # CachedEmbeddings carries the id of the model it wraps
+    return getattr(embeddings, 'model_id', getattr(embeddings, 'model', ''))
+
+
+def stored_embedding_model(db_path):
+    """ :return: id of the model a vector database was embedded with, None if it was stored before ids were kept """
+    path = os.path.join(db_path, EMBEDDING_META_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)['model']
+
+
+def save_vector_store(vector_store, db_path, embeddings):
+    """ save a vector store built by build_vector_store together with the id of its embedding model """
+    vector_store.save_local(db_path)
+    dim = vector_store.vectors.shape[1] if isinstance(vector_store, MappedVectorStore) else vector_store.index.d
+    with open(os.path.join(db_path, EMBEDDING_META_FILE), 'w') as f:
+        json.dump({'model': embedding_model_id(embeddings), 'dim': int(dim)}, f)
+
+
+def load_vector_store(db_path, embeddings, check_model=True):
+    """ :param check_model: refuse embeddings of another model than the one the database was embedded with """
+    model = stored_embedding_model(db_path) if check_model else None
+    # vectors of different models are not comparable, a query must be embedded by the model of the database
+    assert model is None or model == embedding_model_id(embeddings), \
+        "{} was embedded with {}, the current embedding model is {} (see embedding_backend in cfg.py); " \
+        "remove the directory to embed the report again".format(db_path, model, embedding_model_id(embeddings))
+    if cfg.vector_storage == 'mmap':
+        if not is_mapped(db_path):  # stored in the faiss format by an earlier run
+            convert_to_mapped(db_path, embeddings)
+        return MappedVectorStore.load(db_path, embeddings)
+    assert os.path.exists(os.path.join(db_path, 'index.faiss')), \
+        "{} was stored with vector_storage = 'mmap'".format(db_path)
+    vector_store = FAISS.load_local(db_path, embeddings=embeddings)
+    set_search_params(vector_store.index)
+    return vector_store
+
+
+def convert_to_mapped(db_path, embeddings):
+    """ write the mapped files of a vector database stored in the faiss format, the faiss files are kept """
+    vector_store = FAISS.load_local(db_path, embeddings=embeddings)
+    docs = [vector_store.docstore.search(vector_store.index_to_docstore_id[i])
+            for i in range(vector_store.index.ntotal)]
+    MappedVectorStore(embeddings.embed_query, index_vectors(vector_store.index), [doc.page_content for doc in docs],
+                      [int(doc.metadata['page']) for doc in docs]).save_local(db_path)
+
+
+def load_vectors(db_path):
+    """ :return: float32 matrix of the chunk vectors of a stored vector database, its texts are not read """
+    if is_mapped(db_path):
+        return np.asarray(load_mapped_vectors(db_path), dtype=np.float32)
+    return index_vectors(faiss.read_index(os.path.join(db_path, 'index.faiss')))
+
+
+def index_vectors(index):
+    """ :return: float32 matrix of the vectors stored in the index (decoded approximations for pq indexes) """
+    try:
+        # ivf indexes only reconstruct by id with a direct map
+        faiss.extract_index_ivf(index).make_direct_map()
+    except RuntimeError:  # not an ivf index
+        pass
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def compare_index_types(vectors, query_vectors, k=20, index_types=INDEX_TYPES, repeats=5):
+    """
+    recall@k against exact search and search latency of every index type on the same vectors and queries
+    :return: dict from index type to its measurements
+    """
+    exact = build_index(vectors, 'flat')
+    _, truth = exact.search(query_vectors, k)
+    results = {}
+    for index_type in index_types:
+        start_time = time.time()
+        index = build_index(vectors, index_type)
+        build_time = time.time() - start_time
+        start_time = time.time()
+        for _ in range(repeats):
+            _, found = index.search(query_vectors, k)
+        latency = (time.time() - start_time) / repeats / len(query_vectors)
+        hits = sum(len(set(t[t >= 0]) & set(f[f >= 0])) for t, f in zip(truth, found))
+        relevant = sum(len(t[t >= 0]) for t in truth)
+        results[index_type] = {
+            'factory': index_factory_string(index_type, *vectors.shape),
+            'recall@{}'.format(k): round(hits / max(relevant, 1), 4),
+            'ms_per_query': round(latency * 1000, 4),
+            'build_seconds': round(build_time, 3),
+            'bytes': int(faiss.serialize_index(index).nbytes),
+        }
+    return results
+
+
+def main():
+    from document import QUERIES, load_chunks, get_embeddings, CHUNKS_FILE
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db_paths", type=str, nargs='+', required=True,
+                        help="vector databases whose chunks are pooled into one index")
+    parser.add_argument("--top_k", type=int, default=20)
+    parser.add_argument("--output", type=str, default='')
+    args = parser.parse_args()
+
+    texts = []
+    for db_path in args.db_paths:
+        if not os.path.exists(os.path.join(db_path, CHUNKS_FILE)) and not is_mapped(db_path):
+            print('{}: no stored chunks, skipped'.format(db_path))
+            continue
+        texts.extend(load_chunks(db_path)[0])
+    if not texts:
+        parser.error('no chunks found in --db_paths')
+    # chunks of stored reports are usually in the embedding cache already
+    embeddings = get_embeddings()
+    queries = [q for query in QUERIES.values() for q in (query if isinstance(query, list) else [query])]
+    vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    query_vectors = np.asarray(embeddings.embed_documents(queries), dtype=np.float32)
+    results = compare_index_types(vectors, query_vectors, k=min(args.top_k, len(texts)))
+    print(json.dumps({'num_vectors': len(texts), 'num_queries': len(queries), 'index_types': results}, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()